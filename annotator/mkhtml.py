@@ -1,6 +1,7 @@
 #!/usr/bin/env python
 import sys
 import os.path
+from itertools import islice
 from comment import CommentEntry
 from srcdb import SourceDB, SourceMap
 
@@ -9,8 +10,10 @@ BASEDIR = os.path.dirname(__file__)
 def q(s):
     return s.replace('&','&amp;').replace('>','&gt;').replace('<','&lt;').replace('"','&quot;')
 
-def show_html_headers():
-    print('''<!DOCTYPE html>
+# html_headers: returns the page header.
+def html_headers():
+    a = []
+    a.append('''<!DOCTYPE html>
 <html>
 <meta http-equiv="Content-Type" content="text/html; charset=utf-8" />
 <style>
@@ -21,10 +24,10 @@ pre { margin: 1em; background: #eeeeee; }
 </style>
 ''')
     with open(os.path.join(BASEDIR, 'helper.js')) as fp:
-        print('<script>')
-        print(fp.read())
-        print('</script>')
-    print('''
+        a.append('<script>')
+        a.append(fp.read())
+        a.append('</script>')
+    a.append('''
 <body onload="run('a')">
 <h1>Comment Tagging Experiment</h1>
 
@@ -151,9 +154,10 @@ while ((m = ch.receive()) != null) {
 </td></tr>
 </table>
 ''')
-    return
+    return ''.join( s+'\n' for s in a )
 
-def show(cid, src, spans, key, url, ncontext=4):
+# render: returns the html of a snippet.
+def render(cid, src, spans, key, url, ncontext=4):
     ranges = [(s,e,True) for (s,e) in spans]
     lines = []
     linenos = set()
@@ -177,16 +181,100 @@ def show(cid, src, spans, key, url, ncontext=4):
     name = os.path.basename(src.name)
     lineno0 = min(linenos)+1
     lineno1 = max(linenos)+1
-    print('<div class=src><div class=head>%s:' % (cid))
-    print('<span id="%s" class=ui> </span>' % (cid))
-    print('<a target="original" href="%s#L%d-L%d">%s</a></div>' %
-          (q(url), lineno0, lineno1, name))
+    a = []
+    a.append('<div class=src><div class=head>%s:' % (cid))
+    a.append('<span id="%s" class=ui> </span>' % (cid))
+    a.append('<a target="original" href="%s#L%d-L%d">%s</a></div>' %
+             (q(url), lineno0, lineno1, name))
     if key is not None:
-        print('<div class=key>key=%s</div>' % (q(key)))
-    print('<pre>')
-    for line in lines:
-        print(line)
-    print('</pre></div>\n')
+        a.append('<div class=key>key=%s</div>' % (q(key)))
+    a.append('<pre>')
+    a.extend(lines)
+    a.append('</pre></div>\n')
+    return ''.join( s+'\n' for s in a )
+
+# Each worker process reads the sources with its own SourceDB.
+_srcdb = None
+def _initworker(basedir):
+    global _srcdb
+    _srcdb = SourceDB(basedir)
+    return
+
+def _renderworker(args):
+    (cid, path, spans, key, url, ncontext) = args
+    src = _srcdb.get(path)
+    return (cid, render(cid, src, spans, key, url, ncontext=ncontext))
+
+# render_all: yields (cid, html) of each entry in order.
+def render_all(ents, basedir, srcmap, ncontext=4, nprocs=1):
+    def batches():
+        index = 0
+        while True:
+            # Look up the urls of a batch at once.
+            batch = list(islice(ents, 1000))
+            if not batch: break
+            urls = srcmap.geturls( e.path for e in batch )
+            tasks = []
+            for e in batch:
+                cid = 'c%03d' % index
+                tasks.append((cid, e.path, e.spans, e.key, urls[e.path], ncontext))
+                index += 1
+            yield tasks
+        return
+    if 1 < nprocs:
+        from multiprocessing import Pool
+        pool = Pool(nprocs, _initworker, (basedir,))
+        try:
+            for tasks in batches():
+                for x in pool.imap(_renderworker, tasks, 16):
+                    yield x
+        finally:
+            pool.terminate()
+    else:
+        _initworker(basedir)
+        for tasks in batches():
+            for x in map(_renderworker, tasks):
+                yield x
+    return
+
+# write_pages: writes the snippets into pages of pagesize
+#   and an index page.
+def write_pages(outdir, snippets, pagesize=100):
+    def pagename(i):
+        return 'page%03d.html' % i
+    def nav(i, hasnext):
+        a = ['<a href="index.html">index</a>']
+        if 1 < i:
+            a.append('<a href="%s">prev</a>' % pagename(i-1))
+        if hasnext:
+            a.append('<a href="%s">next</a>' % pagename(i+1))
+        return '<div class=nav>%s</div>\n' % ' | '.join(a)
+    def write(i, page, hasnext):
+        data = headers + nav(i, hasnext) + ''.join( h for (_,h) in page ) + nav(i, hasnext)
+        with open(os.path.join(outdir, pagename(i)), 'w') as fp:
+            fp.write(data)
+        index.append('<li> <a href="%s">%s</a>: %s - %s\n' %
+                     (pagename(i), pagename(i), page[0][0], page[-1][0]))
+        return
+    if not os.path.isdir(outdir):
+        os.makedirs(outdir)
+    headers = html_headers()
+    index = []
+    # A page is written when the next one begins.
+    page = None
+    i = 0
+    while True:
+        snips = list(islice(snippets, pagesize))
+        if page is not None:
+            write(i, page, bool(snips))
+        if not snips: break
+        (i, page) = (i+1, snips)
+    data = ('<!DOCTYPE html>\n<html>\n'
+            '<meta http-equiv="Content-Type" content="text/html; charset=utf-8" />\n'
+            '<body>\n<h1>Comment Tagging Experiment</h1>\n<ul>\n%s</ul>\n' %
+            ''.join(index))
+    with open(os.path.join(outdir, 'index.html'), 'w') as fp:
+        fp.write(data)
     return
 
 def main(argv):
@@ -194,32 +282,38 @@ def main(argv):
     import getopt
     def usage():
         print('usage: %s [-B basedir] [-M srcmap.db] '
-              '[-c context] out.comm' %
+              '[-c context] [-j nprocs] [-o outdir] [-n pagesize] out.comm' %
               argv[0])
         return 100
     try:
-        (opts, args) = getopt.getopt(argv[1:], 'B:M:c:')
+        (opts, args) = getopt.getopt(argv[1:], 'B:M:c:j:o:n:')
     except getopt.GetoptError:
         return usage()
-    srcdb = None
+    basedir = None
     srcmap = None
     ncontext = 4
+    nprocs = 1
+    outdir = None
+    pagesize = 100
     for (k, v) in opts:
-        if k == '-B': srcdb = SourceDB(v)
-        elif k == '-M': srcmap = SourceMap(v)
+        if k == '-B': basedir = v
+        elif k == '-M': srcmap = SourceMap(v, readonly=True)
         elif k == '-c': ncontext = int(v)
+        elif k == '-j': nprocs = int(v)
+        elif k == '-o': outdir = v
+        elif k == '-n': pagesize = int(v)
     if not args: return usage()
 
-    show_html_headers()
-
     fp = fileinput.input(args)
-    index = 0
-    for e in CommentEntry.load(fp):
-        src = srcdb.get(e.path)
-        url = srcmap.geturl(e.path)
-        cid = 'c%03d' % index
-        show(cid, src, e.spans, e.key, url, ncontext=ncontext)
-        index += 1
+    ents = CommentEntry.load(fp)
+    snippets = render_all(ents, basedir, srcmap,
+                          ncontext=ncontext, nprocs=nprocs)
+    if outdir is None:
+        sys.stdout.write(html_headers())
+        for (_,html) in snippets:
+            sys.stdout.write(html)
+    else:
+        write_pages(outdir, snippets, pagesize=pagesize)
 
     return 0
 
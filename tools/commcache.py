@@ -0,0 +1,281 @@
+#!/usr/bin/env python
+##
+##  commcache.py
+##
+##  Binary cache of .comm files:
+##    $ commcache.py comments.comm ...
+##  writes comments.commc next to each file.  CommentEntry.load()
+##  and CommentEntry.scan() read the cache instead of the text while
+##  it is up to date.
+##
+##  Layout (little-endian):
+##    header   magic, version, source mtime/size, counts.
+##    strings  (nstrs+1) int64 offsets followed by NUL-terminated
+##             UTF-8 data.  Paths, feature names and values share
+##             this table.
+##    index    (nents+1) int64 offsets into the records.
+##    records  int32: path, nspans, (start, end)*nspans,
+##                    nfeats, (name, value)*nfeats.
+##    columns  int32: ncols, name*ncols, then for each name the
+##             value of every entry (-1 if missing).
+##
+##  The columns let scan() and the where= of load() work on whole
+##  columns instead of decoding every record.
+##
+import sys
+import os
+import struct
+from array import array
+from itertools import compress, repeat
+from operator import and_
+
+MAGIC = b'COMC'
+VERSION = 2
+HEADER = struct.Struct('<4sIqqqqq')
+
+def cachepath(path):
+    return path+'c'
+
+def _align(n):
+    return (n+7) & ~7
+
+
+##  CommentCache
+##
+class CommentCache:
+
+    def __init__(self, path):
+        import mmap
+        self.path = path
+        with open(path, 'rb') as fp:
+            self._mm = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+        (magic, version, self.mtime, self.size,
+         nstrs, nents, nints) = HEADER.unpack_from(self._mm, 0)
+        if magic != MAGIC or version != VERSION:
+            raise ValueError(path)
+        mv = memoryview(self._mm)
+        i = HEADER.size
+        self._stroffs = mv[i:i+(nstrs+1)*8].cast('q')
+        i += (nstrs+1)*8
+        self._strdata = mv[i:i+self._stroffs[nstrs]]
+        i += _align(self._stroffs[nstrs])
+        self._entoffs = mv[i:i+(nents+1)*8].cast('q')
+        i += (nents+1)*8
+        self._ints = mv[i:i+nints*4].cast('i')
+        i += nints*4
+        ncols = mv[i:i+4].cast('i')[0]
+        i += 4
+        names = mv[i:i+ncols*4].cast('i')
+        i += ncols*4
+        # _cols: {name: values} of the feature columns.
+        self._cols = {}
+        for name in names:
+            self._cols[name] = mv[i:i+nents*4].cast('i')
+            i += nents*4
+        self._strs = [None]*nstrs
+        return
+
+    def __repr__(self):
+        return ('<CommentCache(%s): ents=%r>' % (self.path, len(self)))
+
+    def __len__(self):
+        return len(self._entoffs)-1
+
+    def getstr(self, i):
+        s = self._strs[i]
+        if s is None:
+            offs = self._stroffs
+            s = self._strs[i] = str(self._strdata[offs[i]:offs[i+1]-1], 'utf-8')
+        return s
+
+    def get(self, i):
+        a = self._ints
+        j = self._entoffs[i]
+        path = self.getstr(a[j])
+        n = a[j+1]
+        j += 2
+        spans = [ (a[j+2*k], a[j+2*k+1]) for k in range(n) ]
+        j += 2*n
+        n = a[j]
+        j += 1
+        getstr = self.getstr
+        feats = { getstr(a[j+2*k]): getstr(a[j+2*k+1]) for k in range(n) }
+        return (path, spans, feats)
+
+    def _getstrs(self):
+        strs = str(self._strdata, 'utf-8').split('\0')[:-1]
+        if len(strs) != len(self._strs):
+            strs = [ self.getstr(i) for i in range(len(self._strs)) ]
+        return strs
+
+    # _select: returns a mask of the entries that have all the
+    #   (name, value) of where, or None if none can.
+    def _select(self, codes, where):
+        mask = None
+        for (k,v) in where:
+            if k not in codes or v not in codes: return None
+            col = self._cols.get(codes[k])
+            if col is None: return None
+            m = bytes(map(codes[v].__eq__, col))
+            mask = m if mask is None else bytes(map(and_, mask, m))
+        return mask
+
+    # load: yields all the entries.
+    #   The string table is decoded at once, and records are
+    #   copied out in blocks rather than one int at a time.
+    #   keys, where and spans are as in CommentEntry.load().
+    def load(self, klass, block=4096, keys=None, where=None, spans=True):
+        strs = self._getstrs()
+        getstr = strs.__getitem__
+        # Features and conditions are compared by their codes.
+        codes = { s:i for (i,s) in enumerate(strs) }
+        keep = None
+        if keys is not None:
+            keep = frozenset( codes[k] for k in keys if k in codes )
+        mask = None
+        if where:
+            mask = self._select(codes, where)
+            if mask is None: return
+        entoffs = self._entoffs
+        ints = self._ints
+        n = len(self)
+        for i0 in range(0, n, block):
+            i1 = min(n, i0+block)
+            if mask is not None and not any(mask[i0:i1]): continue
+            a = ints[entoffs[i0]:entoffs[i1]].tolist()
+            j = 0
+            for i in range(i0, i1):
+                path = strs[a[j]]
+                j0 = j
+                j1 = j+2+2*a[j+1]
+                j = j1+1+2*a[j1]
+                if mask is not None and not mask[i]: continue
+                if spans:
+                    ss = list(zip(a[j0+2:j1:2], a[j0+3:j1:2]))
+                else:
+                    ss = []
+                if keep is None:
+                    feats = dict(zip(map(getstr, a[j1+1:j:2]),
+                                     map(getstr, a[j1+2:j:2])))
+                else:
+                    feats = { strs[k]: strs[v] for (k,v)
+                              in zip(a[j1+1:j:2], a[j1+2:j:2]) if k in keep }
+                yield klass(path, ss, feats)
+        return
+
+    # scan: returns an iterator of tuples of the values of fields
+    #   (None for a missing one), one for each entry that has all of
+    #   where.  It reads only the columns and makes no entries.
+    def scan(self, fields, where=None):
+        strs = self._getstrs()
+        codes = { s:i for (i,s) in enumerate(strs) }
+        # Code -1 (a missing value) gives the None at the end.
+        getstr = (strs+[None]).__getitem__
+        n = len(self)
+        cols = []
+        for k in fields:
+            col = self._cols.get(codes.get(k))
+            cols.append(repeat(None, n) if col is None else map(getstr, col))
+        rows = zip(*cols)
+        if where:
+            mask = self._select(codes, where)
+            if mask is None: return iter(())
+            rows = compress(rows, mask)
+        return rows
+
+    # open: returns the cache of a .comm file if it is up to date.
+    @classmethod
+    def open(klass, srcpath):
+        if not isinstance(srcpath, str): return None
+        if sys.byteorder != 'little': return None
+        path = cachepath(srcpath)
+        try:
+            st = os.stat(srcpath)
+            cache = klass(path)
+        except (OSError, ValueError):
+            return None
+        if cache.mtime != st.st_mtime_ns or cache.size != st.st_size:
+            return None
+        return cache
+
+# write_cache: converts a .comm file into its cache.
+def write_cache(srcpath, klass):
+    strs = {}
+    def code(s):
+        if s not in strs:
+            strs[s] = len(strs)
+        return strs[s]
+    entoffs = array('q', [0])
+    ints = array('i')
+    st = os.stat(srcpath)
+    with open(srcpath) as fp:
+        for line in fp:
+            if not line.startswith('@'): continue
+            try:
+                e = klass.fromstring(line.strip())
+            except ValueError:
+                raise ValueError(line)
+            ints.append(code(e.path))
+            ints.append(len(e.spans))
+            for (s,t) in e.spans:
+                ints.append(s)
+                ints.append(t)
+            ints.append(len(e.feats))
+            for (k,v) in e.feats.items():
+                ints.append(code(k))
+                ints.append(code(v))
+            entoffs.append(len(ints))
+    nents = len(entoffs)-1
+    cols = {}
+    for i in range(nents):
+        j = entoffs[i]
+        j += 2+2*ints[j+1]
+        for k in range(ints[j]):
+            name = ints[j+1+2*k]
+            if name not in cols:
+                cols[name] = array('i', [-1])*nents
+            cols[name][i] = ints[j+2+2*k]
+    stroffs = array('q', [0])
+    data = bytearray()
+    for s in strs:
+        data.extend(s.encode('utf-8'))
+        data.append(0)
+        stroffs.append(len(data))
+    data.extend(bytes(_align(len(data))-len(data)))
+    path = cachepath(srcpath)
+    tmppath = path+'.tmp'
+    with open(tmppath, 'wb') as fp:
+        fp.write(HEADER.pack(MAGIC, VERSION, st.st_mtime_ns, st.st_size,
+                             len(strs), nents, len(ints)))
+        fp.write(stroffs.tobytes())
+        fp.write(data)
+        fp.write(entoffs.tobytes())
+        fp.write(ints.tobytes())
+        fp.write(array('i', [len(cols)]).tobytes())
+        fp.write(array('i', cols.keys()).tobytes())
+        for col in cols.values():
+            fp.write(col.tobytes())
+    os.replace(tmppath, path)
+    return path
+
+def main(argv):
+    import getopt
+    from comment import CommentEntry
+    def usage():
+        print('usage: %s [-f] file.comm ...' % argv[0])
+        return 100
+    try:
+        (opts, args) = getopt.getopt(argv[1:], 'f')
+    except getopt.GetoptError:
+        return usage()
+    force = False
+    for (k, v) in opts:
+        if k == '-f': force = True
+    if not args: return usage()
+    for path in args:
+        if not force and CommentCache.open(path) is not None: continue
+        sys.stderr.write(path+'...\n'); sys.stderr.flush()
+        write_cache(path, CommentEntry)
+    return 0
+
+if __name__ == '__main__': sys.exit(main(sys.argv))
@@ -1,8 +1,45 @@
 #!/usr/bin/env python
 import sys
+import fileinput
+from sys import intern
 
+##  FieldTable
+##
+##  Maps a 'k=v' field to its (k, v) pair, so that repeated fields
+##  are split only once and share their strings.  Fields with a
+##  numeric value (line=, cols=, ...) can take any number of values,
+##  so they may only fill half of the table.
+##
+class FieldTable(dict):
+
+    def __init__(self, maxsize=1<<16):
+        dict.__init__(self)
+        self.maxsize = maxsize
+        self.maxnums = maxsize//2
+        self.path = None
+        return
+
+    def __missing__(self, x):
+        (k,_,v) = x.partition('=')
+        kv = (intern(k), v)
+        if len(self) < self.maxsize:
+            if not v.isdigit():
+                self[x] = kv
+            elif 0 < self.maxnums:
+                self.maxnums -= 1
+                self[x] = kv
+        return kv
+
+##  CommentEntry
+##
+##  Entries are slotted, and load() shares feature strings through
+##  a FieldTable.  The target is 1KB per loaded entry with the usual
+##  15-20 features.  Before this change an entry took about 2.6KB.
+##
 class CommentEntry:
 
+    __slots__ = ('path', 'spans', 'feats', 'key')
+
     def __init__(self, path, spans, feats, key=None):
         self.path = path
         self.spans = spans
@@ -41,34 +78,142 @@ class CommentEntry:
         self.spans.extend(entry.spans)
         return
 
+    # fromstring: parses a line.
+    #   fields is a FieldTable shared between lines.
+    #   If keys is given, only those features are parsed.
+    #   If spans is false, spans are not parsed (and left empty).
     @classmethod
-    def fromstring(klass, line):
+    def fromstring(klass, line, fields=None, keys=None, spans=True):
         if not line.startswith('@'): raise ValueError(line)
-        (_,_,line) = line.partition(' ')
-        (path,_,line) = line.partition(' ')
-        (ss,_,line) = line.partition(' ')
-        spans = []
-        for x in ss.split(','):
-            (s,_,e) = x.partition(':')
-            spans.append((int(s), int(e)))
-        feats = {}
-        for x in line.split(' '):
-            (k,_,v) = x.partition('=')
-            feats[k] = v
+        if fields is None:
+            fields = FieldTable(0)
+        if keys is None:
+            f = line.split(' ')
+        else:
+            f = line.split(' ', 3)
+        path = f[1] if 1 < len(f) else ''
+        ss = f[2] if 2 < len(f) else ''
+        if spans:
+            spans = []
+            for x in ss.split(','):
+                (s,_,e) = x.partition(':')
+                spans.append((int(s), int(e)))
+        else:
+            spans = []
+        if keys is None:
+            feats = dict(map(fields.__getitem__, f[3:] or ['']))
+        else:
+            # Look up each key in the rest of the line.
+            # The last one wins like in a dict.
+            i0 = len(f[0])+len(path)+len(ss)+2
+            feats = {}
+            for k in keys:
+                i = line.rfind(' '+k+'=', i0)
+                if i < 0: continue
+                i += len(k)+2
+                j = line.find(' ', i)
+                feats[k] = line[i:j] if 0 <= j else line[i:]
+        if path == fields.path:
+            path = fields.path
+        else:
+            fields.path = path
         return klass(path, spans, feats)
 
+    # load: reads entries from a file or fileinput.
+    #   A .comm file that has an up-to-date cache (see commcache.py)
+    #   is read from the cache instead.
+    #   fields: feature names to load (None for all).
+    #   where: {name: value} that an entry must have.  These
+    #     features are always loaded.
+    #   spans: if false, spans are not loaded.
     @classmethod
-    def load(klass, fp):
+    def load(klass, fp, fields=None, where=None, spans=True):
+        from commcache import CommentCache
+        keys = None
+        if fields is not None:
+            keys = list(fields)
+            if where:
+                keys.extend( k for k in where if k not in keys )
+        where = list(where.items()) if where else []
+        # Lines without these strings are skipped before parsing.
+        needles = [ ' %s=%s' % (k,v) for (k,v) in where ]
+        args = dict(keys=keys, where=where, spans=spans)
+        cache = CommentCache.open(getattr(fp, 'name', None))
+        if cache is not None:
+            for e in cache.load(klass, **args):
+                yield e
+            return
+        isinput = isinstance(fp, fileinput.FileInput)
+        table = FieldTable()
         for line in fp:
-            if line.startswith('@'):
+            if isinput and fp.isfirstline():
+                cache = CommentCache.open(fp.filename())
+                if cache is not None:
+                    for e in cache.load(klass, **args):
+                        yield e
+                    fp.nextfile()
+                    continue
+            if not line.startswith('@'): continue
+            for x in needles:
+                if x not in line: break
+            else:
                 try:
-                    yield klass.fromstring(line.strip())
+                    e = klass.fromstring(line.strip(), table,
+                                         keys=keys, spans=spans)
                 except ValueError:
                     raise ValueError(line)
+                for (k,v) in where:
+                    if e.feats.get(k) != v: break
+                else:
+                    yield e
         return
 
+    # scan: yields a tuple of the values of fields for each entry
+    #   (None for a missing one).  where is as in load().  A file
+    #   with a cache is read without making entries, which is much
+    #   cheaper for tools that only count a few features.
+    @classmethod
+    def scan(klass, fp, fields, where=None):
+        from commcache import CommentCache
+        cache = CommentCache.open(getattr(fp, 'name', None))
+        if cache is not None:
+            where = list(where.items()) if where else []
+            for x in cache.scan(fields, where):
+                yield x
+            return
+        for e in klass.load(fp, fields=fields, where=where, spans=False):
+            get = e.feats.get
+            yield tuple( get(k) for k in fields )
+        return
+
+# DELTAS: the features added by derive_deltas().
+DELTAS = ('deltaLine', 'deltaCols', 'deltaLeft', 'deltaRight')
+
+# derive_deltas: adds the numeric line/column deltas to an entry.
+#   deltaLine = line-prevLine    deltaCols = cols-prevCols
+#   deltaLeft = line-leftLine    deltaRight = line-rightLine
+#   line and cols are parsed first, so a bad value fails the same
+#   way whichever deltas the entry has. The deltas are stored as ints.
+def derive_deltas(e):
+    feats = e.feats
+    get = feats.get
+    line = int(get('line'))
+    cols = int(get('cols'))
+    v = get('prevLine')
+    if v is not None:
+        feats['deltaLine'] = line - int(v)
+    v = get('prevCols')
+    if v is not None:
+        feats['deltaCols'] = cols - int(v)
+    v = get('leftLine')
+    if v is not None:
+        feats['deltaLeft'] = line - int(v)
+    v = get('rightLine')
+    if v is not None:
+        feats['deltaRight'] = line - int(v)
+    return e
+
 def main(argv):
-    import fileinput
     args = argv[1:]
     fp = fileinput.input(args)
     for entry in CommentEntry.load(fp):
@@ -1,7 +1,9 @@
 #!/usr/bin/env python
 import sys
-from comment import CommentEntry
-from learncomm import TreeBuilder
+from itertools import islice
+from comment import CommentEntry, derive_deltas
+from learncomm import TreeBuilder, load_tree
+from forest import load_forest
 from learncomm import add_cat_feats
 from srcdb import SourceDB
 
@@ -48,76 +50,141 @@ def pythonify(v0):
 
 def Z(x): return max(1, x)
 
+# classify: classifies a batch of entries.
+#   Returns (output, mat, keys) where mat counts (key, predicted) pairs.
+def classify(ents, predict, srcdb=None, pythonmode=False,
+             keyprop='keyCategory', resprop='predCategory'):
+    out = []
+    mat = {}
+    keys = set()
+    for e in ents:
+        if 'parentTypes' not in e: continue
+        if pythonmode:
+            e['parentTypes'] = pythonify(e['parentTypes'])
+            if 'leftTypes' in e:
+                e['leftTypes'] = pythonify(e['leftTypes'])
+            if 'rightTypes' in e:
+                e['rightTypes'] = pythonify(e['rightTypes'])
+        # ignore non-local comments.
+        if 'Block,MethodDeclaration' not in e['parentTypes']: continue
+        derive_deltas(e)
+
+        cat0 = e[keyprop]
+        assert cat0, e
+        keys.add(cat0)
+        cat1 = predict(e)
+        keys.add(cat1)
+        e[resprop] = cat1
+        if cat0 is not None and cat0 != 'u':
+            k = (cat0,cat1)
+            mat[k] = mat.get(k, 0)+1
+        out.append(str(e)+'\n')
+        if srcdb is not None:
+            src = srcdb.get(e.path)
+            ranges = [(s,e,1) for (s,e) in e.spans]
+            for (_,line) in src.show(ranges):
+                out.append(line)
+            out.append('\n')
+    return (''.join(out), mat, keys)
+
+# Each worker process loads the tree and the sources by itself.
+_classifyargs = None
+def _initworker(path, load, basedir, mapped, kwargs):
+    global _classifyargs
+    builder = TreeBuilder()
+    add_cat_feats(builder)
+    predict = load(path, builder)
+    srcdb = None
+    if basedir is not None:
+        srcdb = SourceDB(basedir, mapped=mapped)
+    _classifyargs = dict(predict=predict, srcdb=srcdb, **kwargs)
+    return
+
+def _classifyworker(lines):
+    return classify(CommentEntry.load(lines), **_classifyargs)
+
+# classify_all: yields (output, mat, keys) of each batch in order.
+#   With nprocs, the lines of fp are sent to the workers as they are
+#   and parsed there, which is much cheaper than pickling entries.
+def classify_all(fp, path, load=load_tree, basedir=None, mapped=False,
+                 nprocs=1, batchsize=1000, **kwargs):
+    initargs = (path, load, basedir, mapped, kwargs)
+    if 1 < nprocs:
+        from multiprocessing import Pool
+        def batches():
+            lines = ( line for line in fp if line.startswith('@') )
+            while True:
+                batch = list(islice(lines, batchsize))
+                if not batch: break
+                yield batch
+            return
+        pool = Pool(nprocs, _initworker, initargs)
+        try:
+            for x in pool.imap(_classifyworker, batches()):
+                yield x
+        finally:
+            pool.terminate()
+    else:
+        _initworker(*initargs)
+        ents = CommentEntry.load(fp)
+        while True:
+            batch = list(islice(ents, batchsize))
+            if not batch: break
+            yield classify(batch, **_classifyargs)
+    return
+
 def main(argv):
     import getopt
     import fileinput
     def usage():
-        print('usage: %s [-d] [-P] [-B srcdb] [-k keyprop] [-r resprop] [file ...]' %
+        print('usage: %s [-d] [-P] [-F] [-B srcdb] [-M] [-k keyprop] [-r resprop] '
+              '[-j nprocs] [-b batchsize] [file ...]' %
               argv[0])
         return 100
     try:
-        (opts, args) = getopt.getopt(argv[1:], 'dPB:k:r:')
+        (opts, args) = getopt.getopt(argv[1:], 'dPFB:Mk:r:j:b:')
     except getopt.GetoptError:
         return usage()
     debug = 0
     pythonmode = False
+    load = load_tree
     srcdb = None
+    mapped = False
     keyprop = 'keyCategory'
     resprop = 'predCategory'
+    nprocs = 1
+    batchsize = 1000
     for (k, v) in opts:
         if k == '-d': debug += 1
         elif k == '-P': pythonmode = True
-        elif k == '-B': srcdb = SourceDB(v)
+        elif k == '-F': load = load_forest
+        elif k == '-B': srcdb = v
+        elif k == '-M': mapped = True
         elif k == '-k': keyprop = v
         elif k == '-r': resprop = v
-    builder = TreeBuilder()
-    add_cat_feats(builder)
+        elif k == '-j': nprocs = int(v)
+        elif k == '-b': batchsize = int(v)
+    if not args: return usage()
 
     path = args.pop(0)
-    with open(path) as fp:
-        data = eval(fp.read())
-    tree = builder.import_tree(data)
+    # Load the tree once here so that the workers find it cached.
+    builder = TreeBuilder()
+    add_cat_feats(builder)
+    load(path, builder)
 
     mat = {}
     keys = set()
     fp = fileinput.input(args)
-    for e in CommentEntry.load(fp):
-        if 'parentTypes' not in e: continue
-        if pythonmode:
-            e['parentTypes'] = pythonify(e['parentTypes'])
-            if 'leftTypes' in e:
-                e['leftTypes'] = pythonify(e['leftTypes'])
-            if 'rightTypes' in e:
-                e['rightTypes'] = pythonify(e['rightTypes'])
-        # ignore non-local comments.
-        if 'Block,MethodDeclaration' not in e['parentTypes']: continue
-        line = int(e['line'])
-        cols = int(e['cols'])
-        if 'prevLine' in e:
-            e['deltaLine'] = line - int(e['prevLine'])
-        if 'prevCols' in e:
-            e['deltaCols'] = cols - int(e['prevCols'])
-        if 'leftLine' in e:
-            e['deltaLeft'] = line - int(e['leftLine'])
-        if 'rightLine' in e:
-            e['deltaRight'] = line - int(e['rightLine'])
-
-        cat0 = e[keyprop]
-        assert cat0, e
-        keys.add(cat0)
-        cat1 = tree.test(e)
-        keys.add(cat1)
-        e[resprop] = cat1
-        if cat0 is not None and cat0 != 'u':
-            k = (cat0,cat1)
-            mat[k] = mat.get(k, 0)+1
-        print(e)
-        if srcdb is not None:
-            src = srcdb.get(e.path)
-            ranges = [(s,e,1) for (s,e) in e.spans]
-            for (_,line) in src.show(ranges):
-                print(line, end='')
-            print()
+    results = classify_all(fp, path, load=load,
+                           basedir=srcdb, mapped=mapped,
+                           nprocs=nprocs, batchsize=batchsize,
+                           pythonmode=pythonmode,
+                           keyprop=keyprop, resprop=resprop)
+    for (out,m,ks) in results:
+        sys.stdout.write(out)
+        for (k,v) in m.items():
+            mat[k] = mat.get(k, 0)+v
+        keys.update(ks)
     #
     if debug:
         #keys = sorted(keys)
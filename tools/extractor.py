@@ -1,30 +1,117 @@
-#!/usr/bin/env python2
+#!/usr/bin/env python3
 import sys
 import ast
 import tokenize
+import hashlib
+from array import array
+from bisect import bisect_left, bisect_right
 from comment import CommentEntry
 
-def bisect_right(a, x):
-    lo = 0
-    hi = len(a)
-    while lo < hi:
-        mid = (lo+hi)//2
-        (k,_) = a[mid]
-        if x < k: hi = mid
-        else: lo = mid+1
-    return lo
-
-def bisect_left(a, x):
-    lo = 0
-    hi = len(a)
-    while lo < hi:
-        mid = (lo+hi)//2
-        (k,_) = a[mid]
-        if k < x: lo = mid+1
-        else: hi = mid
-    return lo
+# Bump this when the output changes (it invalidates ExtractCache).
+VERSION = 3
 
+# isnegnum: true if node is a negative number literal.
+#   Python 2 folds "-1" into a single Num.
+def isnegnum(node):
+    if not (isinstance(node, ast.UnaryOp) and
+            isinstance(node.op, ast.USub)): return False
+    v = node.operand
+    return (isinstance(v, ast.Constant) and
+            isinstance(v.value, (int, float, complex)) and
+            not isinstance(v.value, bool) and
+            node.end_lineno == v.end_lineno and
+            node.end_col_offset == v.end_col_offset)
+
+# OPGROUPS: binary operators that chain without parentheses.
+OPGROUPS = {}
+for (g,ops) in enumerate((
+        (ast.Add, ast.Sub),
+        (ast.Mult, ast.MatMult, ast.Div, ast.Mod, ast.FloorDiv),
+        (ast.LShift, ast.RShift),
+        (ast.BitOr,), (ast.BitXor,), (ast.BitAnd,))):
+    for op in ops:
+        OPGROUPS[op] = g
+
+# ischained: true if node continues a chain of binary operations
+#   such as "a + b - c".
+def ischained(node):
+    if not (isinstance(node, ast.BinOp) and
+            isinstance(node.left, ast.BinOp)): return False
+    v = node.left
+    g = OPGROUPS.get(type(node.op))
+    return (g is not None and g == OPGROUPS.get(type(v.op)) and
+            v.lineno == node.lineno and v.col_offset == node.col_offset)
+
+# isslice: true if node is a slice in Python 2.
+def isslice(node):
+    return (isinstance(node, ast.Slice) or
+            (isinstance(node, ast.Constant) and node.value is Ellipsis))
+
+##  Print, Exec, Index, ExtSlice
+##
+##  Python 2 nodes that Python 3 no longer has.
+##
+class Print(ast.stmt):
+    _fields = ('dest', 'values')
+
+class Exec(ast.stmt):
+    _fields = ('body', 'globals', 'locals')
+
+class Index(ast.AST):
+    _fields = ('value',)
+
+class ExtSlice(ast.AST):
+    _fields = ('dims',)
+
+# isprintto: true if node is the "print >>f" part of a print statement.
+def isprintto(node):
+    return (isinstance(node, ast.BinOp) and
+            isinstance(node.op, ast.RShift) and
+            isinstance(node.left, ast.Name) and
+            node.left.id == 'print')
+
+# getslice: returns a subscript as Python 2 has it.
+def getslice(node):
+    if isslice(node):
+        return node
+    elif isinstance(node, ast.Tuple) and any(map(isslice, node.elts)):
+        return ExtSlice(dims=[ getslice(e) for e in node.elts ])
+    return Index(value=node)
+
+# RESHAPED: nodes whose children differ in Python 2.
+RESHAPED = (ast.UnaryOp, ast.With, ast.Try, ast.ExceptHandler,
+            ast.Call, ast.Subscript, ast.arguments)
+
+# HASBODY: nodes that can contain expression statements.
+HASBODY = (ast.mod, ast.stmt, ast.excepthandler, ast.match_case)
+
+# Node types that getnodespan() moves.
+DEFS = (ast.FunctionDef, ast.AsyncFunctionDef, ast.ClassDef)
+TRAILERS = (ast.Call, ast.Attribute, ast.Subscript)
+COMPS = (ast.GeneratorExp, ast.ListComp, ast.SetComp, ast.DictComp)
+
+# haspos: true if node has a position that counts as a span.
+def haspos(node):
+    return (isinstance(node, (ast.expr, ast.stmt, ast.arg)) and
+            not isslice(node))
+
+# nodename: returns the node type.
+#   Node types are named as in Python 2 so that the output
+#   stays compatible with the existing data.
 def nodename(node):
+    if isinstance(node, ast.Constant):
+        v = node.value
+        if v is None or isinstance(v, bool): return 'Name'
+        if v is Ellipsis: return 'Ellipsis'
+        if isinstance(v, (str, bytes)): return 'Str'
+        return 'Num'
+    elif isinstance(node, ast.arg):
+        return 'Name'
+    elif isinstance(node, ast.Try):
+        if node.finalbody: return 'TryFinally'
+        return 'TryExcept'
+    elif isnegnum(node):
+        return 'Num'
     return type(node).__name__
 
 def bl(x):
@@ -37,180 +124,415 @@ class Source:
 
     def __init__(self, tab=8):
         self.tab = tab
-        self.lines = []
+        # offsets: start of each line (and the end of text).
+        self.offsets = array('l')
+        # tabs: {row: (positions, columns)} of tabs in a line.
+        self.tabs = {}
+        # wide: rows that have non-ASCII characters.
+        self.wide = set()
         self.text = ''
-        self.tokens = []
-        self.toklen = {}
-        self.nodestart = {}
-        self.nodeend = {}
-        self.parent = {}
-        self.node_start = []
-        self.node_end = []
+        # comments: start and end of each comment token.
+        self.comments = array('l')
+        # tok_start, tok_end: the other tokens.
+        #   parens: {start of '(': end of its ')'}.
+        self.tok_start = array('l')
+        self.tok_end = array('l')
+        self.parens = {}
+        # printfunc: true if print is a function.
+        self.printfunc = False
+        # Nodes are numbered in preorder (the Module is 0).
+        #   node_start is -1 for nodes without a position.
+        self.typenames = []
+        self.node_type = array('i')
+        self.node_start = array('l')
+        self.node_end = array('l')
+        self.node_parent = array('l')
+        # Positioned nodes sorted by (start, length) and (end, length).
+        self.start_pos = array('l')
+        self.start_node = array('l')
+        self.end_pos = array('l')
+        self.end_node = array('l')
+        # spans: node spans sorted by (start, -end), outer first.
+        #   span_parent[i] is the innermost span that contains span i.
+        self.span_start = array('l')
+        self.span_end = array('l')
+        self.span_node = array('l')
+        self.span_parent = array('l')
         return
 
     def load(self, fp):
+        lines = []
+        n = 0
         for line in fp:
             line = line.decode('utf-8')
             line = line.replace(u'\ufeff',u'').replace(u'\ufffe',u'').replace('\r','')
-            self.lines.append((len(self.text), line))
-            self.text += line
-        self.lines.append((len(self.text), ''))
+            if '\t' in line:
+                self.tabs[len(lines)] = self._tabcols(line)
+            if not line.isascii():
+                self.wide.add(len(lines))
+            lines.append(line)
+            self.offsets.append(n)
+            n += len(line)
+        self.offsets.append(n)
+        self.text = u''.join(lines)
         return
 
+    def _tabcols(self, line):
+        positions = []
+        columns = []
+        col = 0
+        i0 = 0
+        while True:
+            i1 = line.find('\t', i0)
+            if i1 < 0: break
+            col = (((col+i1-i0)//self.tab)+1)*self.tab
+            positions.append(i1)
+            columns.append(col)
+            i0 = i1+1
+        return (positions, columns)
+
     def get(self, start, end):
         return self.text[start:end]
 
     def getindex(self, loc):
         (row,col) = loc
-        (index,_) = self.lines[row-1]
-        return (index+col)
+        return self.offsets[row-1]+col
+
+    # getnodeindex: like getindex, but for ast positions
+    #   whose columns are counted in UTF-8 bytes.
+    def getnodeindex(self, loc):
+        (row,col) = loc
+        index = self.offsets[row-1]
+        if row-1 in self.wide:
+            line = self.text[index:self.offsets[row]].encode('utf-8')
+            col = len(line[:col].decode('utf-8'))
+        return index+col
+
+    # getnodeloc: returns the ast position of an index.
+    def getnodeloc(self, index):
+        row = self.getrow(index)
+        col = index - self.offsets[row]
+        if row in self.wide:
+            col = len(self.text[self.offsets[row]:index].encode('utf-8'))
+        return (row+1, col)
 
     def getrow(self, index):
-        return bisect_right(self.lines, index)-1
+        return bisect_right(self.offsets, index)-1
 
     def getcol(self, index):
-        lineno = bisect_right(self.lines, index)-1
-        (i0,_) = self.lines[lineno]
-        col = 0
-        for c in self.text[i0:index]:
-            if c == '\t':
-                col = ((col//self.tab)+1)*self.tab
-            else:
-                col += 1
+        lineno = bisect_right(self.offsets, index)-1
+        col = index - self.offsets[lineno]
+        if lineno in self.tabs:
+            (positions, columns) = self.tabs[lineno]
+            i = bisect_right(positions, col-1)-1
+            if 0 <= i:
+                col = columns[i] + (col-positions[i]-1)
         return col
 
     def tokenize(self):
         self._i = 0
         def readline():
-            if self._i < len(self.lines):
-                (_,line) = self.lines[self._i]
+            if self._i+1 < len(self.offsets):
+                line = self.text[self.offsets[self._i]:self.offsets[self._i+1]]
                 self._i += 1
                 return line
             else:
                 return ''
+        skip = (tokenize.NL, tokenize.NEWLINE, tokenize.INDENT,
+                tokenize.DEDENT, tokenize.ENDMARKER)
+        offsets = self.offsets
+        stack = []
         for (t,s,start,end,line) in tokenize.generate_tokens(readline):
-            i0 = self.getindex(start)
-            i1 = self.getindex(end)
-            self.toklen[i0] = (i1-i0)
-            self.tokens.append((t, i0, i1))
+            if t in skip: continue
+            i0 = offsets[start[0]-1]+start[1]
+            i1 = offsets[end[0]-1]+end[1]
+            if t == tokenize.COMMENT:
+                self.comments.append(i0)
+                self.comments.append(i1)
+                continue
+            if s == '(':
+                stack.append(i0)
+            elif s == ')' and stack:
+                self.parens[stack.pop()] = i1
+            self.tok_start.append(i0)
+            self.tok_end.append(i1)
         return
 
-    def getlen(self, node):
-        return self.getend(node) - self.nodestart[node]
+    # gettoken: returns the token that starts at index, or -1.
+    def gettoken(self, index):
+        a = self.tok_start
+        k = bisect_left(a, index)
+        if k < len(a) and a[k] == index: return k
+        return -1
 
-    def getstart(self, node):
-        return self.nodestart[node]
+    # getnexttoken: returns the first token at or after index.
+    def getnexttoken(self, index):
+        return bisect_left(self.tok_start, index)
+
+    # getstmt: returns a print or exec statement as Python 2
+    #   has it, or the node itself.
+    def getstmt(self, node):
+        v = node.value
+        if (isinstance(v, ast.Call) and isinstance(v.func, ast.Name) and
+            not v.keywords):
+            args = v.args
+            if v.func.id == 'exec' and 1 <= len(args) <= 3:
+                stmt = Exec(*(args + [None]*(3-len(args))))
+            elif v.func.id == 'print' and not self.printfunc:
+                if len(args) == 1:
+                    values = args
+                else:
+                    # print(a, b) prints a tuple.
+                    t = ast.copy_location(ast.Tuple(elts=args, ctx=ast.Load()), v)
+                    loc = (v.func.end_lineno, v.func.end_col_offset)
+                    k = self.getnexttoken(self.getnodeindex(loc))
+                    (t.lineno, t.col_offset) = self.getnodeloc(self.tok_start[k])
+                    values = [t]
+                stmt = Print(None, values)
+            else:
+                return node
+        elif self.printfunc:
+            return node
+        elif isinstance(v, ast.Name) and v.id == 'print':
+            stmt = Print(None, [])
+        elif isprintto(v):
+            stmt = Print(v.right, [])
+        elif isinstance(v, ast.Tuple) and v.elts and isprintto(v.elts[0]):
+            stmt = Print(v.elts[0].right, v.elts[1:])
+        else:
+            return node
+        return ast.copy_location(stmt, node)
 
-    def getend(self, node):
-        if node in self.nodeend:
-            end = self.nodeend[node]
+    # getchildren: returns the child nodes as Python 2 has them.
+    def getchildren(self, node):
+        if not isinstance(node, RESHAPED):
+            a = list(ast.iter_child_nodes(node))
+        elif isnegnum(node):
+            a = []
+        elif isinstance(node, ast.With) and 1 < len(node.items):
+            # with a, b: is two nested with statements.
+            item = node.items[0]
+            inner = ast.With(items=node.items[1:], body=node.body)
+            ast.copy_location(inner, node.items[1].context_expr)
+            a = [ c for c in (item.context_expr, item.optional_vars, inner) if c ]
+        elif isinstance(node, ast.With):
+            item = node.items[0]
+            a = [ c for c in (item.context_expr, item.optional_vars) if c ]
+            a.extend(node.body)
+        elif isinstance(node, ast.Try) and node.handlers and node.finalbody:
+            # try: except: finally: is a TryExcept inside a TryFinally.
+            inner = ast.Try(body=node.body, handlers=node.handlers,
+                            orelse=node.orelse, finalbody=[])
+            ast.copy_location(inner, node)
+            a = [inner] + node.finalbody
+        elif isinstance(node, ast.ExceptHandler) and node.name:
+            # The name after "as" is a Name.
+            loc = (node.type.end_lineno, node.type.end_col_offset)
+            k = self.getnexttoken(self.getnodeindex(loc))
+            while self.text[self.tok_start[k]:self.tok_end[k]] != 'as':
+                k += 1
+            name = ast.Name(id=node.name, ctx=ast.Store())
+            (name.lineno, name.col_offset) = self.getnodeloc(self.tok_start[k+1])
+            a = [node.type, name] + node.body
+        elif isinstance(node, ast.Call):
+            # *args and **kwargs are bare expressions.
+            a = [node.func]
+            a.extend( c.value if isinstance(c, ast.Starred) else c for c in node.args )
+            a.extend( c if c.arg else c.value for c in node.keywords )
+        elif isinstance(node, ast.Subscript):
+            a = [node.value, getslice(node.slice), node.ctx]
+        elif isinstance(node, ast.arguments):
+            # *args and **kwargs are plain names.
+            a = [ c for c in ast.iter_child_nodes(node)
+                  if c is not node.vararg and c is not node.kwarg ]
         else:
-            end = 0
-            if isinstance(node, ast.expr) or isinstance(node, ast.stmt):
-                loc = (node.lineno, node.col_offset)
-                index = self.getindex(loc)
-                end = max(end, index+self.toklen.get(index, 0))
-            for c in ast.iter_child_nodes(node):
-                end = max(end, self.getend(c))
-            self.nodeend[node] = end
-        return end
-
-    def getparents(self, node):
+            a = list(ast.iter_child_nodes(node))
+        if isinstance(node, HASBODY):
+            a = [ self.getstmt(c) if isinstance(c, ast.Expr) else c for c in a ]
+        return a
+
+    # getnodespan: returns where Python 2 puts a node and where
+    #   its first token ends.
+    #   Python 2 starts a node after its opening bracket, an elif
+    #   at its test, a with statement at its first item, a decorated
+    #   definition at its first decorator, "(a).b" where "a" starts
+    #   and all but the first operation of "a + b + c" at its
+    #   operator. A node that starts with a string spanning several
+    #   lines starts just before the last line of the string, where
+    #   no token starts.
+    def getnodespan(self, node):
+        text = self.text
+        t = type(node)
+        if t in DEFS and node.decorator_list:
+            i = self.getnodeindex((node.decorator_list[0].lineno, node.col_offset))
+        else:
+            i = self.getnodeindex((node.lineno, node.col_offset))
+            # "(a).b" and "(a)(b)" start where "a" does.
+            while t in TRAILERS and text[i] == '(':
+                node = node.func if t is ast.Call else node.value
+                t = type(node)
+                i = self.getnodeindex((node.lineno, node.col_offset))
+        a = self.tok_start
+        k = bisect_left(a, i)
+        if k == len(a) or a[k] != i: return (i, i)
+        if t is ast.Tuple:
+            loc = (node.end_lineno, node.end_col_offset)
+            if node.elts and self.parens.get(i) == self.getnodeindex(loc):
+                k += 1
+        elif t in COMPS:
+            k += 1
+        elif t is ast.If or t is ast.With:
+            if text[i:self.tok_end[k]] in ('elif', 'with'):
+                k += 1
+        elif t is ast.BinOp and ischained(node):
+            loc = (node.left.end_lineno, node.left.end_col_offset)
+            k = self.getnexttoken(self.getnodeindex(loc))
+        (i, j) = (a[k], self.tok_end[k])
+        if text.find('\n', i, j) != -1:
+            i = j = self.offsets[self.getrow(j)]-1
+        return (i, j)
+
+    def getcomments(self):
+        a = self.comments
+        return zip(a[0::2], a[1::2])
+
+    def getname(self, i):
+        return self.typenames[self.node_type[i]]
+
+    def getlen(self, i):
+        return self.node_end[i] - self.node_start[i]
+
+    def getstart(self, i):
+        return self.node_start[i]
+
+    def getend(self, i):
+        return self.node_end[i]
+
+    def getparents(self, i):
         nodes = []
-        while node is not None:
-            nodes.append(node)
-            node = self.parent.get(node)
+        while 0 <= i:
+            nodes.append(i)
+            i = self.node_parent[i]
         return nodes
 
     def parse(self):
         tree = ast.parse(self.text)
-        node_start = {}
-        node_end = {}
-        def add(node, start, end):
-            self.nodestart[node] = start
-            if start in node_start:
-                a = node_start[start]
-            else:
-                a = node_start[start] = []
-            a.append(node)
-            if end in node_end:
-                a = node_end[end]
-            else:
-                a = node_end[end] = []
-            a.append(node)
-            return
-        def walk(node):
-            if isinstance(node, ast.Module):
-                start = 0
-                end = len(self.text)
-                add(node, start, end)
-            elif isinstance(node, ast.expr) or isinstance(node, ast.stmt):
-                loc = (node.lineno, node.col_offset)
-                start = self.getindex(loc)
-                end = self.getend(node)
-                add(node, start, end)
-            for c in ast.iter_child_nodes(node):
-                self.parent[c] = node
-                walk(c)
-            return
-        walk(tree)
-        for (pos,nodes) in node_start.items():
-            nodes.sort(key=self.getlen)
-            self.node_start.append((pos, nodes))
-        self.node_start.sort(key=lambda x:x[0])
-        for (pos,nodes) in node_end.items():
-            nodes.sort(key=self.getlen)
-            self.node_end.append((pos, nodes))
-        self.node_end.sort(key=lambda x:x[0])
+        for node in tree.body:
+            if (isinstance(node, ast.ImportFrom) and
+                node.module == '__future__' and
+                any( a.name == 'print_function' for a in node.names )):
+                self.printfunc = True
+        # Number the nodes in preorder.
+        nodes = []
+        parent = self.node_parent
+        stack = [(tree, -1)]
+        while stack:
+            (node, i) = stack.pop()
+            parent.append(i)
+            i = len(nodes)
+            nodes.append(node)
+            a = self.getchildren(node)
+            a.reverse()
+            stack.extend( (c, i) for c in a )
+        del tree
+        n = len(nodes)
+        types = {}
+        start = self.node_start = array('l', [-1])*n
+        end = self.node_end = array('l', [0])*n
+        for (i,node) in enumerate(nodes):
+            name = nodename(node)
+            if name not in types:
+                types[name] = len(self.typenames)
+                self.typenames.append(name)
+            self.node_type.append(types[name])
+            if haspos(node):
+                (start[i], end[i]) = self.getnodespan(node)
+        # As in Python 2, a node ends after its first token or
+        # where its last child ends, whichever comes later.
+        for i in range(n-1, -1, -1):
+            e = end[i]
+            j = parent[i]
+            if 0 <= j and end[j] < e:
+                end[j] = e
+        del nodes
+        start[0] = 0
+        ids = [ i for i in range(n) if 0 <= start[i] ]
+        # The Module spans the whole text.
+        spanend = lambda i: end[i] if i else len(self.text)
+        ids.sort(key=lambda i:(start[i], end[i]-start[i], i))
+        for i in ids:
+            self.start_pos.append(start[i])
+            self.start_node.append(i)
+        ids.sort(key=lambda i:(spanend(i), end[i]-start[i], i))
+        for i in ids:
+            self.end_pos.append(spanend(i))
+            self.end_node.append(i)
+        # Nodes with the same span are ordered parent first.
+        ids.sort(key=lambda i:(start[i], -spanend(i), i))
+        stack = []
+        for (k,i) in enumerate(ids):
+            (s, e) = (start[i], spanend(i))
+            while stack and self.span_end[stack[-1]] <= s:
+                stack.pop()
+            self.span_parent.append(stack[-1] if stack else -1)
+            self.span_start.append(s)
+            self.span_end.append(e)
+            self.span_node.append(i)
+            stack.append(k)
         return
 
+    # getNodesStartAfter: returns the nodes that start first at
+    #   or after pos, shortest first.
     def getNodesStartAfter(self, pos):
-        i = bisect_left(self.node_start, pos)
-        if i == len(self.node_start): return []
-        (_,nodes) = self.node_start[i]
-        return nodes
+        a = self.start_pos
+        i0 = bisect_left(a, pos)
+        if i0 == len(a): return []
+        i1 = bisect_right(a, a[i0])
+        return self.start_node[i0:i1].tolist()
 
+    # getNodesEndBefore: returns the nodes that end last at
+    #   or before pos, shortest first.
     def getNodesEndBefore(self, pos):
-        i = bisect_right(self.node_end, pos)
-        if i == 0: return []
-        (_,nodes) = self.node_end[i-1]
-        return nodes
+        a = self.end_pos
+        i1 = bisect_right(a, pos)
+        if i1 == 0: return []
+        i0 = bisect_left(a, a[i1-1])
+        return self.end_node[i0:i1].tolist()
 
+    # getNodesOutside: returns the nodes that contain (start, end),
+    #   innermost first.
+    #   The last span starting before the comment is either the
+    #   innermost one or inside it, so this only follows the
+    #   containing spans from there.
     def getNodesOutside(self, start, end):
-        i0 = bisect_left(self.node_start, start)
-        i1 = bisect_right(self.node_end, end)
-        a = set()
-        for (_,nodes) in self.node_start[:i0]:
-            a.update(nodes)
-        b = set()
-        for (_,nodes) in self.node_end[i1:]:
-            b.update(nodes)
-        c = list(a.intersection(b))
-        c.sort(key=self.getlen)
-        return c
+        i = bisect_left(self.span_start, start)-1
+        while 0 <= i and self.span_end[i] <= end:
+            i = self.span_parent[i]
+        nodes = []
+        while 0 <= i:
+            nodes.append(self.span_node[i])
+            i = self.span_parent[i]
+        return nodes
 
 # getfeats
 def getfeats(src):
-    for (t,start,end) in src.tokens:
-        if t != tokenize.COMMENT: continue
+    for (start,end) in src.getcomments():
         feats = {'type':'LineComment'}
         feats['line'] = src.getrow(start)
         feats['cols'] = src.getcol(start)
         before = src.getNodesEndBefore(start)
         if before:
-            feats['leftTypes'] = ','.join( nodename(n) for n in before )
+            feats['leftTypes'] = ','.join( src.getname(n) for n in before )
             feats['leftLine'] = src.getrow(src.getend(before[0]))
         after = src.getNodesStartAfter(end)
         if after:
-            feats['rightTypes'] = ','.join( nodename(n) for n in after )
+            feats['rightTypes'] = ','.join( src.getname(n) for n in after )
             feats['rightLine'] = src.getrow(src.getend(after[0]))
-        parent = None
-        for n in src.getNodesOutside(start, end):
-            if parent is None or src.getlen(n) < src.getlen(parent):
-                parent = n
-        if parent is not None:
+        nodes = src.getNodesOutside(start, end)
+        if nodes:
+            parent = nodes[0]
             parents = src.getparents(parent)
-            feats['parentTypes'] = ','.join( nodename(n) for n in parents )
+            feats['parentTypes'] = ','.join( src.getname(n) for n in parents )
             pstart = src.getstart(parent)
             pend = src.getend(parent)
             feats['parentStart'] = bl(pstart == start)
@@ -218,41 +540,102 @@ def getfeats(src):
         yield (start, end, feats)
     return
 
+# extract: returns the entries of a file, or None if it fails.
+def extract(path, tab=8):
+    src = Source(tab=tab)
+    try:
+        with open(path, 'rb') as fp:
+            src.load(fp)
+            src.tokenize()
+            src.parse()
+    except (UnicodeError, SyntaxError, RecursionError, tokenize.TokenError):
+        return None
+    ents = []
+    prev = None
+    for (start,end,feats) in getfeats(src):
+        if prev is not None:
+            (start0,end0) = prev
+            feats['prevLine'] = src.getrow(end0)
+            feats['prevCols'] = src.getcol(start0)
+        prev = (start,end)
+        span = (start+1,end)
+        ents.append(CommentEntry(path, [span], feats))
+        #s = src.get(start+1, end).replace('\n',' ')
+        #print('+ %s\n' % s.encode('utf-8'))
+    return ents
+
+# cachekey: returns the ExtractCache key of a file.
+def cachekey(path, tab=8):
+    with open(path, 'rb') as fp:
+        h = hashlib.sha1(fp.read())
+    return ('%s v%d t%d py%d' %
+            (h.hexdigest(), VERSION, tab, sys.version_info[0]))
+
+# _extractlines: returns the entries without the '@ path ' prefix.
+def _extractlines(args):
+    (path, tab) = args
+    ents = extract(path, tab=tab)
+    if ents is None: return None
+    n = len(path)+3
+    return [ str(ent)[n:] for ent in ents ]
+
 def main(argv):
     import getopt
     def usage():
-        print('usage: %s [-d] [-t tab] [file ...]' % argv[0])
+        print('usage: %s [-d] [-j nprocs] [-C cache.db] [-t tab] [file ...]' % argv[0])
         return 100
     try:
-        (opts, args) = getopt.getopt(argv[1:], 'dt:')
+        (opts, args) = getopt.getopt(argv[1:], 'dj:C:t:')
     except getopt.GetoptError:
         return usage()
     debug = 0
+    nprocs = 1
+    cache = None
     tab = 8
     for (k, v) in opts:
         if k == '-d': debug += 1
+        elif k == '-j': nprocs = int(v)
+        elif k == '-C':
+            from srcdb import ExtractCache
+            cache = ExtractCache(v)
         elif k == '-t': tab = int(v)
+    # files: [(path, key, lines)] where lines is False until extracted.
+    files = []
     for path in args:
-        src = Source(tab=tab)
-        try:
-            with open(path) as fp:
-                src.load(fp)
-                src.tokenize()
-                src.parse()
-        except (UnicodeError, SyntaxError, tokenize.TokenError) as e:
-            sys.stderr.write('! %s\n' % path)
-            continue
-        prev = None
-        for (start,end,feats) in getfeats(src):
-            if prev is not None:
-                (start0,end0) = prev
-                feats['prevLine'] = src.getrow(end0)
-                feats['prevCols'] = src.getcol(start0)
-            prev = (start,end)
-            span = (start+1,end)
-            ent = CommentEntry(path, [span], feats)
-            print(ent)
-            #s = src.get(start+1, end).replace('\n',' ')
-            #print('+ %s\n' % s.encode('utf-8'))
+        (key, lines) = (None, False)
+        if cache is not None:
+            try:
+                key = cachekey(path, tab=tab)
+                lines = cache.get(key)
+            except (IOError, KeyError):
+                pass
+        files.append((path, key, lines))
+    tasks = [ (path, tab) for (path,key,lines) in files if lines is False ]
+    pool = None
+    if 1 < nprocs:
+        from multiprocessing import Pool
+        pool = Pool(nprocs)
+        results = pool.imap(_extractlines, tasks, 8)
+    else:
+        results = ( _extractlines(task) for task in tasks )
+    try:
+        # Results come back in the input order.
+        for (path,key,lines) in files:
+            if lines is False:
+                lines = next(results)
+                if key is not None:
+                    cache.put(key, lines)
+            if lines is None:
+                sys.stderr.write('! %s\n' % path)
+                continue
+            for line in lines:
+                print('@ %s %s' % (path, line))
+    finally:
+        if pool is not None:
+            pool.terminate()
+        if cache is not None:
+            cache.close()
+            sys.stderr.write('cache: %d hits, %d misses\n' %
+                             (cache.hits, cache.misses))
     return
 if __name__ == '__main__': sys.exit(main(sys.argv))
@@ -0,0 +1,204 @@
+#!/usr/bin/env python
+##
+##  forest.py
+##
+##  Training:
+##    $ forest.py -k prop -n 20 comments.feats > out.forest
+##  Testing:
+##    $ forest.py -k prop -f out.forest comments.feats
+##  Applying:
+##    $ detcat.py -F out.forest comments.feats
+##
+##  A forest is a set of trees, each built by TreeBuilder from
+##  a bootstrap sample of the entries and trying a random subset
+##  of the features at each node.  The trees vote on each entry.
+##
+import sys
+import random
+from math import sqrt
+from array import array
+from comment import CommentEntry, derive_deltas
+from learncomm import TreeBuilder, TreeLeaf, CommentTable, TableRows
+from learncomm import countkeys, bestkey, tally, export_tree, load_compiled
+from learncomm import score, print_scores, add_cat_feats
+
+FOREST_FORMAT = 'learncomm-forest'
+FOREST_VERSION = 1
+
+
+##  RandomTreeBuilder
+##
+##  Tries nfeats features chosen at random at each node.
+##
+class RandomTreeBuilder(TreeBuilder):
+
+    def __init__(self, rng, nfeats=None, **kwargs):
+        TreeBuilder.__init__(self, **kwargs)
+        self.rng = rng
+        self.nfeats = nfeats
+        return
+
+    def getfeats(self, ents):
+        feats = list(self.features.values())
+        nfeats = self.nfeats or int(sqrt(len(feats)))
+        if len(feats) <= nfeats: return feats
+        return self.rng.sample(feats, nfeats)
+
+
+##  Forest
+##
+##  Takes the majority vote of compiled trees.
+##  A tie goes to the key that the earliest tree voted for.
+##
+class Forest:
+
+    def __init__(self, predicts):
+        self.predicts = predicts
+        return
+
+    def __repr__(self):
+        return ('<Forest: trees=%r>' % len(self.predicts))
+
+    def __call__(self, e):
+        return bestkey(tally( predict(e) for predict in self.predicts ))
+
+    # predict_all: returns the votes for a batch of entries.
+    #   Each tree is run over the whole batch at once.
+    def predict_all(self, ents):
+        ents = list(ents)
+        votes = [ list(map(predict, ents)) for predict in self.predicts ]
+        return [ bestkey(tally(vs)) for vs in zip(*votes) ]
+
+
+# build_forest: builds ntrees trees from a table and returns them
+#   exported.  Tree i is built with random seed seed+i, so the forest
+#   does not depend on nprocs.
+def build_forest(table, features, ntrees, nfeats=None, seed=0,
+                 nprocs=1, **kwargs):
+    initargs = (list(features), table, nfeats, kwargs)
+    seeds = [ seed+i for i in range(ntrees) ]
+    if 1 < nprocs:
+        from multiprocessing import Pool
+        with Pool(nprocs, _initworker, initargs) as pool:
+            return pool.map(_buildworker, seeds)
+    else:
+        _initworker(*initargs)
+        return list(map(_buildworker, seeds))
+
+# The table is passed once when a worker starts.
+_features = _table = _nfeats = _kwargs = None
+
+def _initworker(features, table, nfeats, kwargs):
+    global _features, _table, _nfeats, _kwargs
+    _features = features
+    _table = table
+    _nfeats = nfeats
+    _kwargs = kwargs
+    return
+
+def _buildworker(seed):
+    rng = random.Random(seed)
+    n = len(_table)
+    rows = array('l', sorted( rng.randrange(n) for _ in range(n) ))
+    builder = RandomTreeBuilder(rng, _nfeats, **_kwargs)
+    for feat in _features:
+        builder.addfeat(feat)
+    ents = TableRows(_table, rows)
+    tree = builder.build(ents)
+    if tree is None:
+        tree = TreeLeaf(bestkey(countkeys(ents)))
+    return export_tree(tree)
+
+# dump_forest: writes exported trees as versioned JSON.
+def dump_forest(trees, fp):
+    import json
+    obj = { 'format': FOREST_FORMAT, 'version': FOREST_VERSION,
+            'trees': trees }
+    json.dump(obj, fp, separators=(',',':'))
+    fp.write('\n')
+    return
+
+# read_forest: returns the exported trees of a forest.
+def read_forest(path):
+    import json
+    with open(path) as fp:
+        try:
+            obj = json.load(fp)
+        except ValueError:
+            obj = None
+    if not isinstance(obj, dict) or obj.get('format') != FOREST_FORMAT:
+        raise ValueError('not a forest: %r' % path)
+    if FOREST_VERSION < obj.get('version', 0):
+        raise ValueError('unsupported forest version: %r' % path)
+    return obj['trees']
+
+# load_forest: reads a forest and compiles its trees.
+#   The compiled trees are cached like load_tree().
+def load_forest(path, builder):
+    predicts = load_compiled(
+        path, FOREST_FORMAT, builder.features.values(),
+        lambda: [ builder.import_tree(t) for t in read_forest(path) ])
+    return Forest(predicts)
+
+# main
+def main(argv):
+    import getopt
+    import fileinput
+    def usage():
+        print('usage: %s [-d] [-j nprocs] [-n ntrees] [-s nfeats] [-S seed] '
+              '[-m minkeys] [-e minetp] [-f forest] [-k keyprop] [file ...]' %
+              argv[0])
+        return 100
+    try:
+        (opts, args) = getopt.getopt(argv[1:], 'dj:n:s:S:m:e:f:k:')
+    except getopt.GetoptError:
+        return usage()
+    debug = 0
+    nprocs = 1
+    ntrees = 10
+    nfeats = None
+    seed = 0
+    minkeys = 10
+    minetp = 0.10
+    forest = None
+    keyprop = 'key'
+    for (k, v) in opts:
+        if k == '-d': debug += 1
+        elif k == '-j': nprocs = int(v)
+        elif k == '-n': ntrees = int(v)
+        elif k == '-s': nfeats = int(v)
+        elif k == '-S': seed = int(v)
+        elif k == '-m': minkeys = int(v)
+        elif k == '-e': minetp = float(v)
+        elif k == '-f': forest = v
+        elif k == '-k': keyprop = v
+
+    builder = TreeBuilder()
+    add_cat_feats(builder)
+
+    fp = fileinput.input(args)
+    ents = []
+    for e in CommentEntry.load(fp):
+        e.key = e[keyprop]
+        assert e.key is not None
+        derive_deltas(e)
+        ents.append(e)
+
+    if forest is None:
+        # training
+        table = CommentTable(ents, builder.features.values())
+        trees = build_forest(table, builder.features.values(), ntrees,
+                             nfeats=nfeats, seed=seed, nprocs=nprocs,
+                             minkeys=minkeys, minetp=minetp, debug=0)
+        if debug:
+            for tree in trees:
+                print()
+                builder.import_tree(tree).dump()
+        dump_forest(trees, sys.stdout)
+    else:
+        # testing
+        predict = load_forest(forest, builder)
+        print_scores(*score([ e.key for e in ents ], predict.predict_all(ents)))
+    return 0
+
+if __name__ == '__main__': sys.exit(main(sys.argv))
@@ -12,8 +12,7 @@ def main(argv):
         (name,_,_) = name.rpartition('-')
         cc = {}
         with open(path) as fp:
-            for e in CommentEntry.load(fp):
-                cat = e['predCategory']
+            for (cat,) in CommentEntry.scan(fp, ['predCategory']):
                 cc[cat] = cc.get(cat, 0)+1
         total = sum(cc.values())
         a = sorted(cc.items(), key=lambda x:x[1], reverse=True)
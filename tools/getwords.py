@@ -1,39 +1,81 @@
 #!/usr/bin/env python
 import sys
+import heapq
+from collections import Counter, OrderedDict
 from comment import CommentEntry
 
 POS1 = frozenset('VB VBZ VBP VBD VBN VBG'.split(' '))
 POS2 = frozenset('NN NNS NNP NNPS'.split(' '))
 NTOP = 100
 
+# countpairs: counts the (verb, noun) pairs where the noun follows the verb.
+#   Nouns are counted from the end of the comment, so each verb takes
+#   the counts of all the nouns after it at once.  The pairs are
+#   added in the order of their first occurrence.
+def countpairs(wc, pairs):
+    # right: {noun: count} after the current word, in the order of
+    #   their first occurrence.
+    right = OrderedDict()
+    verbs = []
+    for (w,p) in reversed(pairs):
+        if p in POS2:
+            right[w] = right.get(w, 0)+1
+            right.move_to_end(w, last=False)
+        elif p in POS1 and right:
+            verbs.append((w, list(right.items())))
+    for (w1,nouns) in reversed(verbs):
+        for (w2,n) in nouns:
+            wc[(w1,w2)] += n
+    return
+
 def getwords(fp):
-    wc = {}
-    for e in CommentEntry.load(fp):
-        cat = e['predCategory']
-        if cat != 'p': continue
-        if 'words' not in e or 'posTags' not in e: continue
-        words = e['words'].split(',')
-        postags = e['posTags'].split(',')
-        pairs = list(zip(words, postags))
-        for (i,(w1,p1)) in enumerate(pairs):
-            if p1 not in POS1: continue
-            for (w2,p2) in pairs[i+1:]:
-                if p2 not in POS2: continue
-                k = (w1,w2)
-                wc[k] = wc.get(k, 0)+1
+    wc = Counter()
+    rows = CommentEntry.scan(fp, ['words', 'posTags'],
+                             where={'predCategory': 'p'})
+    for (words,postags) in rows:
+        if words is None or postags is None: continue
+        words = words.split(',')
+        postags = postags.split(',')
+        countpairs(wc, list(zip(words, postags)))
     return wc
 
+def _getwords(path):
+    with open(path) as fp:
+        return (path, getwords(fp))
+
 def main(argv):
-    args = argv[1:]
-    gwc = {}
-    for path in args:
-        sys.stderr.write(path+'...\n'); sys.stderr.flush()
-        with open(path) as fp:
-            wc = getwords(fp)
-        for k in wc.keys():
-            gwc[k] = gwc.get(k, 0)+1
-    a = sorted(gwc.items(), key=lambda x:x[1], reverse=True)
-    for (k,n) in a[:NTOP]:
+    import getopt
+    def usage():
+        print('usage: %s [-j nprocs] [-n ntop] [file ...]' % argv[0])
+        return 100
+    try:
+        (opts, args) = getopt.getopt(argv[1:], 'j:n:')
+    except getopt.GetoptError:
+        return usage()
+    nprocs = 1
+    ntop = NTOP
+    for (k, v) in opts:
+        if k == '-j': nprocs = int(v)
+        elif k == '-n': ntop = int(v)
+    pool = None
+    if 1 < nprocs:
+        from multiprocessing import Pool
+        pool = Pool(nprocs)
+        results = pool.imap(_getwords, args)
+    else:
+        results = map(_getwords, args)
+    # gwc: the number of files that have each pair.
+    gwc = Counter()
+    try:
+        for (path,wc) in results:
+            sys.stderr.write(path+'...\n'); sys.stderr.flush()
+            gwc.update(wc.keys())
+    finally:
+        if pool is not None:
+            pool.terminate()
+    # nlargest() keeps the order of ties like a stable sort.
+    a = heapq.nlargest(ntop, gwc.items(), key=lambda x:x[1])
+    for (k,n) in a:
         print('#', ' '.join(k), n)
     return 0
 
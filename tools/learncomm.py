@@ -6,10 +6,20 @@
 ##    $ learncomm.py -k prop comments.feats > out.tree
 ##  Testing:
 ##    $ learncomm.py -k prop -f out.tree comments.feats
+##  Profiling the split search (JSON, or CSV for *.csv):
+##    $ learncomm.py -k prop -p profile.json comments.feats > out.tree
+##  Cross validation over parameters:
+##    $ learncomm.py -k prop -c 5 -m 5,10,20 -e 0.05,0.1 comments.feats
+##
+##  Trees are written as JSON (see dump_tree).  Older trees written
+##  as a Python repr can still be read.
 ##
 import sys
+import os
 from math import log2
-from comment import CommentEntry
+from array import array
+from multiprocessing.pool import AsyncResult
+from comment import CommentEntry, DELTAS, derive_deltas
 
 
 def calcetp(values):
@@ -17,16 +27,21 @@ def calcetp(values):
     etp = sum( v*log2(n/v) for v in values ) / n
     return etp
 
-def countkeys(ents):
+def tally(keys):
     d = {}
-    for e in ents:
-        k = e.key
+    for k in keys:
         if k in d:
             d[k] += 1
         else:
             d[k] = 1
     return d
 
+def countkeys(ents):
+    if isinstance(ents, TableRows):
+        keys = ents.table.keys
+        return { keys[k]: v for (k,v) in tally(ents.getkeys()).items() }
+    return tally( e.key for e in ents )
+
 def bestkey(keys):
     maxkey = None
     maxv = 0
@@ -40,6 +55,253 @@ def bestkey(keys):
 def entetp(ents):
     return calcetp(countkeys(ents).values())
 
+def keyetp(keys):
+    return calcetp(tally(keys).values())
+
+# getkeys: returns the keys of entries (key ids for table rows).
+def getkeys(ents):
+    if isinstance(ents, TableRows):
+        return ents.getkeys()
+    return [ e.key for e in ents ]
+
+# subset: takes the entries at the given positions.
+def subset(ents, idxs):
+    if isinstance(ents, TableRows):
+        return ents.subset(idxs)
+    return [ ents[i] for i in idxs ]
+
+# sweepsplit: finds the best threshold over sorted values in one pass.
+#   Running counts are kept for both sides, and each side is summed
+#   in the order countkeys() would see its keys, so that the entropy
+#   is bit-identical to calling entetp() on every slice.
+def sweepsplit(keys, vs):
+    n = len(keys)
+    # nxt[i]: next position of keys[i] (or n).
+    nxt = [n]*n
+    first = {}
+    for i in range(n-1, -1, -1):
+        k = keys[i]
+        nxt[i] = first.get(k, n)
+        first[k] = i
+    left = {}
+    right = {}
+    for k in keys:
+        right[k] = right.get(k, 0)+1
+    minsplit = minetp = None
+    for i in range(1, n):
+        k = keys[i-1]
+        left[k] = left.get(k, 0)+1
+        right[k] -= 1
+        first[k] = nxt[i-1]
+        if vs[i-1] == vs[i]: continue
+        rkeys = sorted(( k for (k,c) in right.items() if c ), key=first.get)
+        avgetp = (i * calcetp(left.values()) +
+                  (n-i) * calcetp([ right[k] for k in rkeys ])) / n
+        if minsplit is None or avgetp < minetp:
+            minetp = avgetp
+            minsplit = i
+    return (minetp, minsplit)
+
+# keyids: numbers the keys in the order of appearance.
+def keyids(keys):
+    ids = {}
+    kids = array('i')
+    for k in keys:
+        if k in ids:
+            kids.append(ids[k])
+        else:
+            kids.append(len(ids))
+            ids[k] = len(ids)
+    return (kids, len(ids))
+
+def countetp(counts):
+    return calcetp([ c for c in counts if c ])
+
+# memberindex: builds an inverted index {value: (rows, counts)}.
+#   rows is the postings list of each value and counts is
+#   its per-key count vector.
+def memberindex(kids, nk, values):
+    index = {}
+    for (i,vs) in enumerate(values):
+        c = kids[i]
+        for v in vs:
+            if v in index:
+                (rows, counts) = index[v]
+                if rows[-1] == i: continue
+            else:
+                (rows, counts) = index[v] = ([], [0]*nk)
+            rows.append(i)
+            counts[c] += 1
+    return index
+
+# membersplit: finds the best value to split on.
+#   The complement of each value is derived from the node total,
+#   so evaluating a value costs O(nkeys) rather than O(nents).
+def membersplit(kids, nk, index):
+    n = len(kids)
+    total = [0]*nk
+    for c in kids:
+        total[c] += 1
+    minarg = minetp = None
+    for (v,(rows,counts)) in index.items():
+        m = len(rows)
+        if m == n: continue
+        others = [ t-c for (t,c) in zip(total, counts) ]
+        avgetp = (m*countetp(counts) + (n-m)*countetp(others)) / n
+        if minarg is None or avgetp < minetp:
+            minetp = avgetp
+            minarg = v
+    return (minetp, minarg)
+
+
+##  CommentTable
+##
+##  Columnar, integer-coded copy of entries for training.
+##  Every string is replaced with a code (0 stands for None), and
+##  each attribute is stored in the form its features read it:
+##    'str':  one code per row.
+##    'list': comma-separated codes as offsets and values (CSR).
+##    'num':  one number per row with a missing mask.
+##
+class CommentTable:
+
+    def __init__(self, ents, features):
+        self.strs = [None]
+        self.keys = []
+        self.keyids = array('i')
+        self.columns = {}
+        self._codes = {None: 0}
+        ents = list(ents)
+        kids = {}
+        for e in ents:
+            k = e.key
+            if k not in kids:
+                kids[k] = len(self.keys)
+                self.keys.append(k)
+            self.keyids.append(kids[k])
+        for feat in features:
+            k = (feat.coltype, feat.attr)
+            if k in self.columns: continue
+            vs = [ e[feat.attr] for e in ents ]
+            self.columns[k] = self._build(feat.coltype, vs)
+        return
+
+    def __repr__(self):
+        return ('<CommentTable: rows=%r, columns=%r>' %
+                (len(self), list(self.columns.keys())))
+
+    def __len__(self):
+        return len(self.keyids)
+
+    def _build(self, coltype, vs):
+        if coltype == 'str':
+            return array('i', ( self.getcode(v) for v in vs ))
+        elif coltype == 'list':
+            offs = array('l', [0])
+            codes = array('i')
+            for v in vs:
+                if v is not None:
+                    codes.extend( self.getcode(x) for x in v.split(',') )
+                offs.append(len(codes))
+            return (offs, codes)
+        elif coltype == 'num':
+            miss = bytearray( v is None for v in vs )
+            vs = [ v for v in vs if v is not None ]
+            if all( type(v) is int for v in vs ):
+                col = array('q', [0]*len(miss))
+            elif all( type(v) is float for v in vs ):
+                col = array('d', [0]*len(miss))
+            else:
+                col = [None]*len(miss)
+            vs = iter(vs)
+            for (r,m) in enumerate(miss):
+                if not m:
+                    col[r] = next(vs)
+            return (col, miss)
+        raise ValueError(coltype)
+
+    def getcode(self, s):
+        if s in self._codes:
+            return self._codes[s]
+        code = self._codes[s] = len(self.strs)
+        self.strs.append(s)
+        return code
+
+    def encode(self, s):
+        return self._codes.get(s, -1)
+
+    def getvalue(self, attr, r):
+        k = ('str', attr)
+        if k in self.columns:
+            return self.strs[self.columns[k][r]]
+        k = ('list', attr)
+        if k in self.columns:
+            (offs, codes) = self.columns[k]
+            (i0, i1) = (offs[r], offs[r+1])
+            if i0 == i1: return None
+            return ','.join( self.strs[c] for c in codes[i0:i1] )
+        k = ('num', attr)
+        if k in self.columns:
+            (col, miss) = self.columns[k]
+            if miss[r]: return None
+            return col[r]
+        return None
+
+    def rows(self):
+        return TableRows(self, array('l', range(len(self))))
+
+##  TableRows
+##
+##  A subset of rows of a CommentTable that can be used
+##  in place of a list of entries.
+##
+class TableRows:
+
+    def __init__(self, table, rows):
+        self.table = table
+        self.rows = rows
+        return
+
+    def __repr__(self):
+        return ('<TableRows: rows=%r>' % (len(self.rows)))
+
+    def __len__(self):
+        return len(self.rows)
+
+    def __iter__(self):
+        for r in self.rows:
+            yield TableRow(self.table, r)
+        return
+
+    def getkeys(self):
+        keyids = self.table.keyids
+        return [ keyids[r] for r in self.rows ]
+
+    def subset(self, idxs):
+        rows = self.rows
+        return TableRows(self.table, array('l', ( rows[i] for i in idxs )))
+
+##  TableRow
+##
+##  A single row of a CommentTable that acts like an entry.
+##
+class TableRow:
+
+    def __init__(self, table, row):
+        self.table = table
+        self.row = row
+        return
+
+    def __repr__(self):
+        return ('<TableRow(%r)>' % (self.row))
+
+    @property
+    def key(self):
+        return self.table.keys[self.table.keyids[self.row]]
+
+    def __getitem__(self, k):
+        return self.table.getvalue(k, self.row)
+
 
 ##  Feature
 ##
@@ -55,15 +317,39 @@ class Feature:
     def __repr__(self):
         return ('<%s: %s>' % (self.__class__.__name__, self.name))
 
+    coltype = 'str'
+
     def get(self, e):
         return e[self.attr]
 
+    # values: returns get() for every entry (coded for table rows).
+    def values(self, ents):
+        if isinstance(ents, TableRows):
+            return self.getcol(ents.table, ents.rows)
+        return [ self.get(e) for e in ents ]
+
+    def getcol(self, table, rows):
+        raise NotImplementedError
+
     def split(self, ents):
         raise NotImplementedError
 
     def ident(self, arg, e):
         raise NotImplementedError
 
+    # idents: returns ident() for every entry.
+    def idents(self, arg, ents):
+        return [ self.ident(arg, e) for e in ents ]
+
+    # compile: returns ident() as a Python expression over get(),
+    #   or None when the feature cannot be compiled.
+    def compile(self, arg):
+        return None
+
+    # ncands: returns the number of candidates split() evaluates.
+    def ncands(self, ents):
+        raise NotImplementedError
+
 ##  DiscreteFeature
 ##
 class DiscreteFeature(Feature):
@@ -75,19 +361,40 @@ class DiscreteFeature(Feature):
     def ident(self, arg, e):
         return self.get(e)
 
+    def idents(self, arg, ents):
+        vs = self.values(ents)
+        if isinstance(ents, TableRows):
+            strs = ents.table.strs
+            vs = [ strs[v] for v in vs ]
+        return vs
+
+    def compile(self, arg):
+        return ('get(%r)' % self.attr)
+
+    def ncands(self, ents):
+        return len(set(self.values(ents)))
+
+    def getcol(self, table, rows):
+        col = table.columns[(self.coltype, self.attr)]
+        return [ col[r] for r in rows ]
+
     def split(self, ents):
         assert 2 <= len(ents)
         d = {}
-        for e in ents:
-            v = self.get(e)
+        for (i,v) in enumerate(self.values(ents)):
             if v in d:
-                d[v].append(e)
+                d[v].append(i)
             else:
-                d[v] = [e]
+                d[v] = [i]
         if len(d) < 2: raise self.InvalidSplit
+        keys = getkeys(ents)
         n = len(ents)
-        avgetp = sum( len(es) * entetp(es) for es in d.values() ) / n
-        split = list(d.items())
+        avgetp = sum( len(idxs) * keyetp([ keys[i] for i in idxs ])
+                      for idxs in d.values() ) / n
+        if isinstance(ents, TableRows):
+            strs = ents.table.strs
+            d = { strs[v]: idxs for (v,idxs) in d.items() }
+        split = [ (v, subset(ents, idxs)) for (v,idxs) in d.items() ]
         return (avgetp, None, split)
 
 DF = DiscreteFeature
@@ -101,6 +408,8 @@ class DiscreteFeatureOne(DiscreteFeature):
         DiscreteFeature.__init__(self, attr, 'DF%d:' % index)
         return
 
+    coltype = 'list'
+
     def get(self, e):
         v = e[self.attr]
         if v is None: return None
@@ -108,6 +417,20 @@ class DiscreteFeatureOne(DiscreteFeature):
         if len(f) <= self.index: return None
         return f[self.index]
 
+    def compile(self, arg):
+        if self.index == 0:
+            return ('_first(get(%r))' % self.attr)
+        return ('_item(get(%r), %d)' % (self.attr, self.index))
+
+    def getcol(self, table, rows):
+        (offs, codes) = table.columns[(self.coltype, self.attr)]
+        index = self.index
+        a = []
+        for r in rows:
+            i = offs[r]+index
+            a.append(codes[i] if i < offs[r+1] else 0)
+        return a
+
 DF1 = DiscreteFeatureOne
 
 ##  MembershipFeature
@@ -118,37 +441,47 @@ class MembershipFeature(Feature):
         Feature.__init__(self, prefix+attr, attr)
         return
 
+    coltype = 'list'
+
     def get(self, e):
         v = e[self.attr]
         if v is None: return []
         return v.split(',')
 
+    def getcol(self, table, rows):
+        (offs, codes) = table.columns[(self.coltype, self.attr)]
+        return [ codes[offs[r]:offs[r+1]] for r in rows ]
+
     def ident(self, arg, e):
         return arg in self.get(e)
 
+    def compile(self, arg):
+        return ('(%r in _members(get(%r)))' % (arg, self.attr))
+
+    def idents(self, arg, ents):
+        if isinstance(ents, TableRows):
+            arg = ents.table.encode(arg)
+        return [ arg in vs for vs in self.values(ents) ]
+
+    def ncands(self, ents):
+        return len(set( v for vs in self.values(ents) for v in vs ))
+
     def split(self, ents):
         assert 2 <= len(ents)
-        d = {}
-        for e in ents:
-            for v in self.get(e):
-                if v in d:
-                    es = d[v]
-                else:
-                    es = d[v] = set()
-                es.add(e)
-        if len(d) < 2: raise self.InvalidSplit
-        n = len(ents)
-        minsplit = minetp = None
-        for (v,es) in d.items():
-            nes = [ e for e in ents if e not in es ]
-            if not nes: continue
-            avgetp = (len(es)*entetp(es) + len(nes)*entetp(nes)) / n
-            if minsplit is None or avgetp < minetp:
-                minetp = avgetp
-                minsplit = (v, nes)
-        if minsplit is None: raise self.InvalidSplit
-        (arg, nes) = minsplit
-        split = [(True, list(d[arg])), (False, nes)]
+        (kids, nk) = keyids(getkeys(ents))
+        index = memberindex(kids, nk, self.values(ents))
+        if len(index) < 2: raise self.InvalidSplit
+        (minetp, arg) = membersplit(kids, nk, index)
+        if arg is None: raise self.InvalidSplit
+        (rows, _) = index[arg]
+        mark = bytearray(len(ents))
+        for i in rows:
+            mark[i] = 1
+        es = subset(ents, rows)
+        nes = subset(ents, [ i for (i,m) in enumerate(mark) if not m ])
+        if isinstance(ents, TableRows):
+            arg = ents.table.strs[arg]
+        split = [(True, es), (False, nes)]
         return (minetp, arg, split)
 
 MF = MembershipFeature
@@ -167,6 +500,14 @@ class MembershipFeatureOne(MembershipFeature):
         if v is None: return []
         return v.split(',')[:self.nmems]
 
+    def compile(self, arg):
+        return ('(%r in _members(get(%r))[:%d])' % (arg, self.attr, self.nmems))
+
+    def getcol(self, table, rows):
+        (offs, codes) = table.columns[(self.coltype, self.attr)]
+        nmems = self.nmems
+        return [ codes[offs[r]:min(offs[r]+nmems, offs[r+1])] for r in rows ]
+
 MF1 = MembershipFeatureOne
 
 ##  QuantitativeFeature
@@ -177,6 +518,8 @@ class QuantitativeFeature(Feature):
         Feature.__init__(self, prefix+attr, attr)
         return
 
+    coltype = 'num'
+
     def ident(self, arg, e):
         v = self.get(e)
         if v is None:
@@ -186,36 +529,43 @@ class QuantitativeFeature(Feature):
         else:
             return 'ge'
 
+    def idents(self, arg, ents):
+        return [ 'un' if v is None else 'lt' if v < arg else 'ge'
+                 for v in self.values(ents) ]
+
+    def compile(self, arg):
+        return ('_compare(get(%r), %r)' % (self.attr, arg))
+
+    def ncands(self, ents):
+        vs = set(self.values(ents))
+        vs.discard(None)
+        return max(0, len(vs)-1)
+
+    def getcol(self, table, rows):
+        (col, miss) = table.columns[(self.coltype, self.attr)]
+        return [ None if miss[r] else col[r] for r in rows ]
+
     def split(self, ents):
         assert 2 <= len(ents)
-        pairs = []
+        vs = self.values(ents)
+        defs = []
         undefs = []
-        for e in ents:
-            v = self.get(e)
+        for (i,v) in enumerate(vs):
             if v is None:
-                undefs.append(e)
+                undefs.append(i)
             else:
-                pairs.append((e, v))
-        if not pairs: raise self.InvalidSplit
-        pairs.sort(key=(lambda ev: ev[1]))
-        es = [ e for (e,_) in pairs ]
-        vs = [ v for (_,v) in pairs ]
-        n = len(pairs)
-        minsplit = minetp = None
-        v0 = vs[0]
-        for i in range(1, n):
-            v1 = vs[i]
-            if v0 == v1: continue
-            v0 = v1
-            avgetp = (i * entetp(es[:i]) + (n-i) * entetp(es[i:])) / n
-            if minsplit is None or avgetp < minetp:
-                minetp = avgetp
-                minsplit = i
+                defs.append(i)
+        if not defs: raise self.InvalidSplit
+        defs.sort(key=vs.__getitem__)
+        keys = getkeys(ents)
+        vs = [ vs[i] for i in defs ]
+        (minetp, minsplit) = sweepsplit([ keys[i] for i in defs ], vs)
         if minsplit is None: raise self.InvalidSplit
         arg = vs[minsplit]
-        split = [('lt', es[:minsplit]), ('ge', es[minsplit:])]
+        split = [('lt', subset(ents, defs[:minsplit])),
+                 ('ge', subset(ents, defs[minsplit:]))]
         if undefs:
-            split.append(('un', undefs))
+            split.append(('un', subset(ents, undefs)))
         return (minetp, arg, split)
 
 QF = QuantitativeFeature
@@ -245,6 +595,22 @@ class TreeBranch:
             #print ('Unknown value: %r: %r' % (self.feature, v))
             return self.default
 
+    # testall: returns test() for every entry.
+    def testall(self, ents):
+        d = {}
+        for (i,v) in enumerate(self.feature.idents(self.arg, ents)):
+            if v in d:
+                d[v].append(i)
+            else:
+                d[v] = [i]
+        keys = [self.default]*len(ents)
+        for (v,idxs) in d.items():
+            if v not in self.children: continue
+            branch = self.children[v]
+            for (i,k) in zip(idxs, branch.testall(subset(ents, idxs))):
+                keys[i] = k
+        return keys
+
     def dump(self, depth=0):
         ind = '  '*depth
         print ('%sBranch %r: %r, default=%r' %
@@ -268,6 +634,9 @@ class TreeLeaf:
     def test(self, e):
         return self.key
 
+    def testall(self, ents):
+        return [self.key]*len(ents)
+
     def dump(self, depth=0):
         ind = '  '*depth
         print ('%sLeaf %r' % (ind, self.key))
@@ -278,19 +647,22 @@ class TreeLeaf:
 ##
 class TreeBuilder:
 
-    def __init__(self, minkeys=10, minetp=0.10, debug=1):
+    def __init__(self, minkeys=10, minetp=0.10, debug=1, profile=None):
         self.features = {}
         self.minkeys = minkeys
         self.minetp = minetp
         self.debug = debug
+        self.profile = profile
         return
 
     def addfeat(self, feat):
         self.features[feat.name] = feat
         return
 
+    # import_tree: builds a tree from export_tree().
+    #   Lists read from JSON are accepted in place of tuples.
     def import_tree(self, tree):
-        if isinstance(tree, tuple):
+        if isinstance(tree, (tuple, list)):
             (name, arg, default, children) = tree
             children = { v: self.import_tree(branch) for (v,branch) in children }
             return TreeBranch(self.features[name], arg, default, children)
@@ -311,22 +683,17 @@ class TreeBuilder:
             if self.debug:
                 print ('%s Too few keys. Stopping.' % ind)
             return None
-        minbranch = minetp = None
-        for feat in self.features.values():
-            try:
-                (etp, arg, split) = feat.split(ents)
-            except Feature.InvalidSplit:
-                continue
-            if minbranch is None or etp < minetp:
-                minetp = etp
-                minbranch = (feat, arg, split)
+        if self.profile is None:
+            (minetp, minbranch) = self.findsplit(ents)
+        else:
+            (minetp, minbranch) = self.profile.findsplit(self, ents, depth)
         if minbranch is None:
             if self.debug:
                 print ('%s No discerning feature. Stopping.' % ind)
             return None
         (feat, arg, split) = minbranch
         if self.debug:
-            print ('%sFeature: %r, arg=%r, etp=%.3f' % (ind, feat, arg, etp))
+            print ('%sFeature: %r, arg=%r, etp=%.3f' % (ind, feat, arg, minetp))
         default = bestkey(keys)
         children = {}
         for (i,(v,es)) in enumerate(split):
@@ -335,7 +702,7 @@ class TreeBuilder:
                 print ('%s Split%d (%d): %r, %r' % (ind, i, len(r), v, r))
             if self.debug:
                 print ('%s Value: %r ->' % (ind, v))
-            branch = self.build(es, depth+1)
+            branch = self.buildsub(es, depth+1)
             if branch is None:
                 keys = countkeys(es)
                 best = bestkey(keys)
@@ -345,6 +712,201 @@ class TreeBuilder:
             children[v] = branch
         return TreeBranch(feat, arg, default, children)
 
+    # getfeats: returns the features to try at a node.
+    def getfeats(self, ents):
+        return self.features.values()
+
+    # findsplit: returns the feature with the least entropy.
+    def findsplit(self, ents):
+        minbranch = minetp = None
+        for feat in self.getfeats(ents):
+            try:
+                (etp, arg, split) = feat.split(ents)
+            except Feature.InvalidSplit:
+                continue
+            if minbranch is None or etp < minetp:
+                minetp = etp
+                minbranch = (feat, arg, split)
+        return (minetp, minbranch)
+
+    def buildsub(self, ents, depth):
+        return self.build(ents, depth)
+
+
+##  SplitProfile
+##
+##  Records the split search of a TreeBuilder.  There is one record
+##  for each node and feature tried: the time spent in split(), the
+##  number of entries and candidates, and the entropy (None if the
+##  feature could not split).  It is used in place of findsplit(),
+##  so it costs nothing when a builder has no profile.
+##
+class SplitProfile:
+
+    FIELDS = ('node', 'depth', 'feature', 'nents', 'ncands',
+              'time', 'etp', 'chosen')
+
+    def __init__(self):
+        self.records = []
+        self.nnodes = 0
+        return
+
+    def __repr__(self):
+        return ('<SplitProfile: nodes=%r, records=%r>' %
+                (self.nnodes, len(self.records)))
+
+    def findsplit(self, builder, ents, depth=0):
+        from time import perf_counter
+        node = self.nnodes
+        self.nnodes += 1
+        n = len(ents)
+        minbranch = minetp = minrec = None
+        for feat in builder.getfeats(ents):
+            t0 = perf_counter()
+            try:
+                (etp, arg, split) = feat.split(ents)
+            except Feature.InvalidSplit:
+                etp = None
+            t = perf_counter()-t0
+            rec = [node, depth, feat.name, n, feat.ncands(ents), t, etp, False]
+            self.records.append(rec)
+            if etp is None: continue
+            if minbranch is None or etp < minetp:
+                minetp = etp
+                minbranch = (feat, arg, split)
+                minrec = rec
+        if minrec is not None:
+            minrec[-1] = True
+        return (minetp, minbranch)
+
+    # summary: returns the totals of each feature, slowest first.
+    def summary(self):
+        d = {}
+        for (_,_,name,n,ncands,t,_,chosen) in self.records:
+            if name not in d:
+                d[name] = { 'feature': name, 'calls': 0, 'time': 0.0,
+                            'nents': 0, 'ncands': 0, 'chosen': 0 }
+            r = d[name]
+            r['calls'] += 1
+            r['time'] += t
+            r['nents'] += n
+            r['ncands'] += ncands
+            r['chosen'] += chosen
+        return sorted(d.values(), key=lambda r: r['time'], reverse=True)
+
+    def dump_json(self, fp):
+        import json
+        obj = { 'features': self.summary(),
+                'records': [ dict(zip(self.FIELDS, rec)) for rec in self.records ] }
+        json.dump(obj, fp, indent=1)
+        fp.write('\n')
+        return
+
+    def dump_csv(self, fp):
+        import csv
+        w = csv.writer(fp)
+        w.writerow(self.FIELDS)
+        w.writerows(self.records)
+        return
+
+    # dump: writes CSV if path ends with .csv, or JSON otherwise.
+    def dump(self, path):
+        with open(path, 'w', newline='') as fp:
+            if path.endswith('.csv'):
+                self.dump_csv(fp)
+            else:
+                self.dump_json(fp)
+        return
+
+
+##  ParallelTreeBuilder
+##
+##  Builds the same tree as TreeBuilder with a process pool.
+##  Features of a node larger than parsize are evaluated in
+##  parallel, and smaller subtrees are built by the workers.
+##  It only works on TableRows.
+##
+class ParallelTreeBuilder(TreeBuilder):
+
+    def __init__(self, nprocs, parsize=10000, **kwargs):
+        TreeBuilder.__init__(self, **kwargs)
+        self.nprocs = nprocs
+        self.parsize = parsize
+        self._pool = None
+        return
+
+    def build(self, ents, depth=0):
+        if self._pool is not None:
+            return TreeBuilder.build(self, ents, depth)
+        from multiprocessing import Pool
+        worker = TreeBuilder(minkeys=self.minkeys, minetp=self.minetp, debug=0)
+        worker.features = self.features
+        with Pool(self.nprocs, _initworker, (worker, ents.table)) as pool:
+            self._pool = pool
+            try:
+                tree = TreeBuilder.build(self, ents, depth)
+                if tree is not None:
+                    tree = self._resolve(tree)
+            finally:
+                self._pool = None
+        return tree
+
+    def findsplit(self, ents):
+        if len(ents) < self.parsize:
+            return TreeBuilder.findsplit(self, ents)
+        names = list(self.features.keys())
+        results = self._pool.map(
+            _splitworker, [ (name, ents.rows) for name in names ])
+        minbranch = minetp = None
+        for (name,result) in zip(names, results):
+            if result is None: continue
+            (etp, arg, split) = result
+            if minbranch is None or etp < minetp:
+                minetp = etp
+                split = [ (v, TableRows(ents.table, rows)) for (v,rows) in split ]
+                minbranch = (self.features[name], arg, split)
+        return (minetp, minbranch)
+
+    def buildsub(self, ents, depth):
+        if len(ents) < self.parsize:
+            return self._pool.apply_async(_buildworker, (ents.rows,))
+        return TreeBuilder.buildsub(self, ents, depth)
+
+    def _resolve(self, tree):
+        if isinstance(tree, TreeBranch):
+            for (v,branch) in tree.children.items():
+                if isinstance(branch, AsyncResult):
+                    branch = self.import_tree(branch.get())
+                else:
+                    branch = self._resolve(branch)
+                tree.children[v] = branch
+        return tree
+
+# The worker state is passed once when a worker starts.
+_worker = _table = None
+
+def _initworker(builder, table):
+    global _worker, _table
+    _worker = builder
+    _table = table
+    return
+
+def _splitworker(args):
+    (name, rows) = args
+    feat = _worker.features[name]
+    try:
+        (etp, arg, split) = feat.split(TableRows(_table, rows))
+    except Feature.InvalidSplit:
+        return None
+    return (etp, arg, [ (v, es.rows) for (v,es) in split ])
+
+def _buildworker(rows):
+    ents = TableRows(_table, rows)
+    tree = _worker.build(ents)
+    if tree is None:
+        tree = TreeLeaf(bestkey(countkeys(ents)))
+    return export_tree(tree)
+
 
 # export_tree
 def export_tree(tree):
@@ -355,11 +917,261 @@ def export_tree(tree):
     else:
         return (tree.key)
 
+TREE_FORMAT = 'learncomm-tree'
+TREE_VERSION = 2
+
+# dump_tree: writes a tree as versioned JSON.
+#   {"format": "learncomm-tree", "version": 2, "tree": export_tree(tree)}
+def dump_tree(tree, fp):
+    import json
+    obj = { 'format': TREE_FORMAT, 'version': TREE_VERSION,
+            'tree': export_tree(tree) }
+    json.dump(obj, fp, separators=(',',':'))
+    fp.write('\n')
+    return
+
+# read_tree: reads a tree written by dump_tree() or a legacy repr
+#   of export_tree().  Neither is evaluated as code.
+def read_tree(path):
+    with open(path) as fp:
+        data = fp.read()
+    if data.lstrip().startswith('{'):
+        import json
+        obj = json.loads(data)
+        if obj.get('format') != TREE_FORMAT:
+            raise ValueError('not a tree: %r' % path)
+        if TREE_VERSION < obj.get('version', 0):
+            raise ValueError('unsupported tree version: %r' % path)
+        return obj['tree']
+    else:
+        import ast
+        return ast.literal_eval(data)
+
+
+# Helpers used by compiled trees.
+def _first(v):
+    if v is None: return None
+    return v.partition(',')[0]
+
+def _item(v, i):
+    if v is None: return None
+    f = v.split(',')
+    if len(f) <= i: return None
+    return f[i]
+
+def _members(v):
+    if v is None: return []
+    return v.split(',')
+
+def _compare(v, arg):
+    if v is None:
+        return 'un'
+    elif v < arg:
+        return 'lt'
+    else:
+        return 'ge'
+
+##  TreeCompiler
+##
+##  Turns a tree into the source of a Python function predict(e)
+##  made of nested if statements.  Like TreeBranch.test(), an
+##  unknown value gives the default of its branch.
+##
+class TreeCompiler:
+
+    # Bump this when the generated code changes.
+    VERSION = 1
+
+    # Subtrees deeper than this go into separate functions.
+    MAXDEPTH = 16
+
+    def __init__(self):
+        self.lines = []
+        self.consts = {}
+        self._funcs = []
+        return
+
+    def compile(self, tree):
+        self._emit(0, 'def predict(e):')
+        self._emit(1, 'get = e.feats.get')
+        self._node(1, tree)
+        while self._funcs:
+            (name, tree) = self._funcs.pop(0)
+            self._emit(0, 'def %s(e, get):' % name)
+            self._node(1, tree)
+        return '\n'.join(self.lines)+'\n'
+
+    def _emit(self, depth, line):
+        self.lines.append('    '*depth + line)
+        return
+
+    def _const(self, prefix, value):
+        name = '_%s%d' % (prefix, len(self.consts))
+        self.consts[name] = value
+        return name
+
+    def _node(self, depth, tree):
+        if isinstance(tree, TreeLeaf):
+            self._emit(depth, 'return %r' % tree.key)
+            return
+        if self.MAXDEPTH < depth:
+            name = '_node%d' % len(self.lines)
+            self._funcs.append((name, tree))
+            self._emit(depth, 'return %s(e, get)' % name)
+            return
+        expr = tree.feature.compile(tree.arg)
+        if expr is None:
+            expr = ('%s.ident(%s, e)' %
+                    (self._const('f', tree.feature), self._const('a', tree.arg)))
+        x = 'x%d' % depth
+        self._emit(depth, '%s = %s' % (x, expr))
+        if all( isinstance(branch, TreeLeaf) for branch in tree.children.values() ):
+            d = { v: branch.key for (v,branch) in tree.children.items() }
+            self._emit(depth, 'return %s.get(%s, %r)' %
+                       (self._const('d', d), x, tree.default))
+            return
+        for (i,(v,branch)) in enumerate(tree.children.items()):
+            op = 'is' if v is None else '=='
+            self._emit(depth, '%s %s %s %r:' % ('if' if i == 0 else 'elif', x, op, v))
+            self._node(depth+1, branch)
+        self._emit(depth, 'return %r' % tree.default)
+        return
+
+# compile_tree: returns a function that gives tree.test(e).
+def compile_tree(tree):
+    compiler = TreeCompiler()
+    src = compiler.compile(tree)
+    code = compile(src, '<tree>', 'exec')
+    return _makepredict(code, compiler.consts, src)
+
+def _makepredict(code, consts, src):
+    env = { '_first': _first, '_item': _item,
+            '_members': _members, '_compare': _compare }
+    env.update(consts)
+    exec(code, env)
+    predict = env['predict']
+    predict.source = src
+    return predict
+
+# load_tree: reads an exported tree and compiles it.
+def load_tree(path, builder):
+    [predict] = load_compiled(
+        path, TREE_FORMAT, builder.features.values(),
+        lambda: [builder.import_tree(read_tree(path))])
+    return predict
+
+# load_compiled: compiles the trees that gettrees() reads from path.
+#   The compiled code is cached in path+'c' (with marshal) and
+#   reused while the file has the same mtime and size and is
+#   loaded as the same format with the same features, so that
+#   a tree using a feature that is not given still fails.
+def load_compiled(path, format, features, gettrees):
+    import marshal
+    from importlib.util import MAGIC_NUMBER
+    st = os.stat(path)
+    feats = tuple(sorted( (f.name, type(f).__name__) for f in features ))
+    key = (MAGIC_NUMBER, TreeCompiler.VERSION, format,
+           st.st_mtime_ns, st.st_size, feats)
+    cachepath = path+'c'
+    try:
+        with open(cachepath, 'rb') as fp:
+            (k, compiled) = marshal.load(fp)
+        if k == key:
+            return [ _makepredict(*x) for x in compiled ]
+    except (OSError, EOFError, ValueError, TypeError):
+        pass
+    compiled = []
+    for tree in gettrees():
+        compiler = TreeCompiler()
+        src = compiler.compile(tree)
+        code = compile(src, '<tree>', 'exec')
+        compiled.append((code, compiler.consts, src))
+    try:
+        tmppath = cachepath+'.tmp'
+        with open(tmppath, 'wb') as fp:
+            marshal.dump((key, compiled), fp)
+        os.replace(tmppath, cachepath)
+    except (OSError, ValueError):
+        pass
+    return [ _makepredict(*x) for x in compiled ]
+
+# score: counts the correct, actual and predicted keys.
+def score(keys0, keys1, counts=None):
+    (correct, keys, resp) = counts or ({}, {}, {})
+    for (k0,k1) in zip(keys0, keys1):
+        keys[k0] = keys.get(k0,0)+1
+        resp[k1] = resp.get(k1,0)+1
+        if k0 == k1:
+            correct[k1] = correct.get(k1,0)+1
+    return (correct, keys, resp)
+
+# print_scores: prints the precision/recall/F of each key.
+def print_scores(correct, keys, resp):
+    for (k,v) in correct.items():
+        p = v/resp[k]
+        r = v/keys[k]
+        f = 2*(p*r)/(p+r)
+        print ('%s: prec=%.3f(%d/%d), recl=%.3f(%d/%d), F=%.3f' %
+               (k, p, v, resp[k], r, v, keys[k], f))
+    print ('%d/%d' % (sum(correct.values()), sum(keys.values())))
+    return
+
+# crossvalidate: trains and tests every (minkeys, minetp) on nfolds folds
+#   of a table, and yields (minkeys, minetp, (correct, keys, resp))
+#   summed over the folds.  Rows are shuffled with a fixed seed
+#   so that the folds are the same between runs.
+def crossvalidate(table, features, nfolds, minkeys, minetps, nprocs=1):
+    import random
+    rows = list(range(len(table)))
+    random.Random(0).shuffle(rows)
+    folds = [ sorted(rows[i::nfolds]) for i in range(nfolds) ]
+    params = [ (m,t) for m in minkeys for t in minetps ]
+    tasks = [ (m, t, i) for (m,t) in params for i in range(nfolds) ]
+    initargs = (list(features), table, folds)
+    if 1 < nprocs:
+        from multiprocessing import Pool
+        with Pool(nprocs, _initcvworker, initargs) as pool:
+            results = pool.map(_cvworker, tasks)
+    else:
+        _initcvworker(*initargs)
+        results = list(map(_cvworker, tasks))
+    results = iter(results)
+    for (m,t) in params:
+        counts = ({}, {}, {})
+        for _ in range(nfolds):
+            for (d,x) in zip(counts, next(results)):
+                for (k,v) in x.items():
+                    d[k] = d.get(k,0)+v
+        yield (m, t, counts)
+    return
+
+# The table and folds are passed once when a worker starts.
+_cvfeatures = _cvtable = _cvfolds = None
+
+def _initcvworker(features, table, folds):
+    global _cvfeatures, _cvtable, _cvfolds
+    _cvfeatures = features
+    _cvtable = table
+    _cvfolds = folds
+    return
+
+def _cvworker(args):
+    (minkeys, minetp, fold) = args
+    builder = TreeBuilder(minkeys=minkeys, minetp=minetp, debug=0)
+    for feat in _cvfeatures:
+        builder.addfeat(feat)
+    rows = sorted( r for (i,rs) in enumerate(_cvfolds) if i != fold for r in rs )
+    train = TableRows(_cvtable, array('l', rows))
+    tree = builder.build(train)
+    if tree is None:
+        tree = TreeLeaf(bestkey(countkeys(train)))
+    test = TableRows(_cvtable, array('l', _cvfolds[fold]))
+    keys = _cvtable.keys
+    return score([ keys[k] for k in test.getkeys() ], tree.testall(test))
+
 def add_target_feats(builder):
-    builder.addfeat(QF('deltaLine'))
-    builder.addfeat(QF('deltaCols'))
-    builder.addfeat(QF('deltaLeft'))
-    builder.addfeat(QF('deltaRight'))
+    for name in DELTAS:
+        builder.addfeat(QF(name))
     builder.addfeat(DF1('rightTypes'))
     builder.addfeat(MF1('rightTypes'))
     builder.addfeat(MF('rightTypes'))
@@ -386,24 +1198,44 @@ def main(argv):
     import getopt
     import fileinput
     def usage():
-        print('usage: %s [-d] [-m minkeys] [-f feats] [-k keyprop] [file ...]' %
+        print('usage: %s [-d] [-j nprocs] [-m minkeys] [-e minetp] [-c nfolds] '
+              '[-p profile] [-f feats] [-k keyprop] [file ...]' %
               argv[0])
         return 100
     try:
-        (opts, args) = getopt.getopt(argv[1:], 'dm:f:k:')
+        (opts, args) = getopt.getopt(argv[1:], 'dj:m:e:c:p:f:k:')
     except getopt.GetoptError:
         return usage()
     debug = 0
-    minkeys = 10
+    nprocs = 1
+    minkeys = [10]
+    minetps = [0.10]
+    nfolds = None
+    profile = None
     feats = None
     keyprop = 'key'
     for (k, v) in opts:
         if k == '-d': debug += 1
-        elif k == '-m': minkeys = int(v)
+        elif k == '-j': nprocs = int(v)
+        elif k == '-m': minkeys = [ int(x) for x in v.split(',') ]
+        elif k == '-e': minetps = [ float(x) for x in v.split(',') ]
+        elif k == '-c': nfolds = int(v)
+        elif k == '-p': profile = v
         elif k == '-f': feats = v
         elif k == '-k': keyprop = v
+    # Cross validation needs at least two folds.
+    if nfolds is not None and nfolds < 2: return usage()
+    # Lists of parameters are only for cross validation.
+    if not nfolds and (1 < len(minkeys) or 1 < len(minetps)): return usage()
 
-    builder = TreeBuilder(minkeys=minkeys, debug=debug)
+    # A profile is only taken in this process.
+    if 1 < nprocs and not nfolds and profile is None:
+        builder = ParallelTreeBuilder(nprocs, minkeys=minkeys[0],
+                                      minetp=minetps[0], debug=debug)
+    else:
+        builder = TreeBuilder(minkeys=minkeys[0], minetp=minetps[0], debug=debug)
+    if profile is not None:
+        builder.profile = SplitProfile()
     add_cat_feats(builder)
 
     fp = fileinput.input(args)
@@ -411,46 +1243,33 @@ def main(argv):
     for e in CommentEntry.load(fp):
         e.key = e[keyprop]
         assert e.key is not None
-        line = int(e['line'])
-        cols = int(e['cols'])
-        if 'prevLine' in e:
-            e['deltaLine'] = line - int(e['prevLine'])
-        if 'prevCols' in e:
-            e['deltaCols'] = cols - int(e['prevCols'])
-        if 'leftLine' in e:
-            e['deltaLeft'] = line - int(e['leftLine'])
-        if 'rightLine' in e:
-            e['deltaRight'] = line - int(e['rightLine'])
+        derive_deltas(e)
         ents.append(e)
+    # Every fold needs an entry.
+    if nfolds and len(ents) < nfolds: return usage()
 
-    if feats is None:
+    if nfolds:
+        # cross validation
+        table = CommentTable(ents, builder.features.values())
+        results = crossvalidate(table, builder.features.values(), nfolds,
+                                minkeys, minetps, nprocs=nprocs)
+        for (m,t,counts) in results:
+            print ('# minkeys=%d, minetp=%.3f' % (m, t))
+            print_scores(*counts)
+    elif feats is None:
         # training
-        root = builder.build(ents)
+        table = CommentTable(ents, builder.features.values())
+        root = builder.build(table.rows())
         if debug:
             print()
             root.dump()
-        print (export_tree(root))
+        dump_tree(root, sys.stdout)
+        if builder.profile is not None:
+            builder.profile.dump(profile)
     else:
         # testing
-        with open(feats) as fp:
-            data = eval(fp.read())
-        tree = builder.import_tree(data)
-        correct = {}
-        keys = {}
-        resp = {}
-        for e in ents:
-            keys[e.key] = keys.get(e.key,0)+1
-            key = tree.test(e)
-            resp[key] = resp.get(key,0)+1
-            if e.key == key:
-                correct[key] = correct.get(key,0)+1
-        for (k,v) in correct.items():
-            p = v/resp[k]
-            r = v/keys[k]
-            f = 2*(p*r)/(p+r)
-            print ('%s: prec=%.3f(%d/%d), recl=%.3f(%d/%d), F=%.3f' %
-                   (k, p, v, resp[k], r, v, keys[k], f))
-        print ('%d/%d' % (sum(correct.values()), sum(keys.values())))
+        predict = load_tree(feats, builder)
+        print_scores(*score([ e.key for e in ents ], map(predict, ents)))
     return 0
 
 if __name__ == '__main__': sys.exit(main(sys.argv))
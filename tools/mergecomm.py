@@ -1,24 +1,33 @@
 #!/usr/bin/env python
 import sys
-from comment import CommentEntry
-from learncomm import TreeBuilder, DF, QF
+from comment import CommentEntry, DELTAS, derive_deltas
+from learncomm import TreeBuilder, DF, QF, load_tree
+from forest import load_forest
 
 def main(argv):
+    import getopt
     import fileinput
+    def usage():
+        print('usage: %s [-F] tree [file ...]' % argv[0])
+        return 100
+    try:
+        (opts, args) = getopt.getopt(argv[1:], 'F')
+    except getopt.GetoptError:
+        return usage()
+    load = load_tree
+    for (k, v) in opts:
+        if k == '-F': load = load_forest
+    if not args: return usage()
+
     builder = TreeBuilder()
     builder.addfeat(DF('type'))
-    builder.addfeat(QF('deltaLine'))
-    builder.addfeat(QF('deltaCols'))
-    builder.addfeat(QF('deltaLeft'))
-    builder.addfeat(QF('deltaRight'))
+    for name in DELTAS:
+        builder.addfeat(QF(name))
     builder.addfeat(DF('parentStart'))
     builder.addfeat(DF('parentEnd'))
 
-    args = argv[1:]
     path = args.pop(0)
-    with open(path) as fp:
-        data = eval(fp.read())
-    tree = builder.import_tree(data)
+    predict = load(path, builder)
 
     def merge(ents):
         e0 = ents.pop(0)
@@ -36,16 +45,7 @@ def main(argv):
     b = []
     prev = None
     for e in CommentEntry.load(fp):
-        line = int(e['line'])
-        cols = int(e['cols'])
-        if 'prevLine' in e:
-            e['deltaLine'] = line - int(e['prevLine'])
-        if 'prevCols' in e:
-            e['deltaCols'] = cols - int(e['prevCols'])
-        if 'leftLine' in e:
-            e['deltaLeft'] = line - int(e['leftLine'])
-        if 'rightLine' in e:
-            e['deltaRight'] = line - int(e['rightLine'])
+        derive_deltas(e)
         if prev is not None:
             if (prev.path != e.path or
                 prev['type'] != e['type'] or
@@ -54,7 +54,7 @@ def main(argv):
                     print(merge(b))
                     b = []
         try:
-            bio = tree.test(e)
+            bio = predict(e)
         except ValueError:
             bio = 'B'
         e['keyBIO'] = bio
@@ -1,19 +1,37 @@
 #!/usr/bin/env python
 import sys
 import os.path
+import re
 import sqlite3
+import pathlib
+from array import array
+from bisect import bisect_left, bisect_right
+from collections import OrderedDict
 
 
 ##  SourceMap
 ##
+##  Maps a file name to its repository, commit and path.
+##  A read-only map can be shared by concurrent reader processes.
+##
 class SourceMap:
 
-    def __init__(self, path):
-        self._conn = sqlite3.connect(path)
+    # Maximum number of names in one query.
+    BATCH = 500
+
+    def __init__(self, path, readonly=False):
+        self.readonly = readonly
+        if readonly:
+            # The path is quoted so that '?' or '#' in it is kept.
+            uri = pathlib.Path(path).resolve().as_uri()+'?mode=ro'
+            self._conn = sqlite3.connect(uri, uri=True)
+        else:
+            self._conn = sqlite3.connect(path)
+            self._conn.execute('PRAGMA journal_mode=WAL;')
         self._cur = self._conn.cursor()
-        try:
+        if not readonly:
             self._cur.executescript('''
-CREATE TABLE SourceMap (
+CREATE TABLE IF NOT EXISTS SourceMap (
     Uid INTEGER PRIMARY KEY,
     FileName TEXT,
     RepoName TEXT,
@@ -21,14 +39,15 @@ CREATE TABLE SourceMap (
     CommitId TEXT,
     SrcPath TEXT
 );
-CREATE INDEX SourceMapIndex ON SourceMap(FileName);
+CREATE INDEX IF NOT EXISTS SourceMapIndex ON SourceMap(FileName);
 ''')
-        except sqlite3.OperationalError:
-            pass
+        # _preload: {name: (reponame, commit, srcpath)} if preloaded.
+        self._preload = None
         return
 
     def close(self):
-        self._conn.commit()
+        if not self.readonly:
+            self._conn.commit()
         return
 
     def add(self, path, reponame, branch, commit, src):
@@ -37,33 +56,181 @@ CREATE INDEX SourceMapIndex ON SourceMap(FileName);
             (path, reponame, branch, commit, src))
         return
 
+    # addmany: inserts rows of (path, reponame, branch, commit, src)
+    #   in a single transaction.
+    def addmany(self, rows):
+        with self._conn:
+            self._cur.executemany(
+                'INSERT INTO SourceMap VALUES (NULL,?,?,?,?,?);',
+                rows)
+        return
+
+    # load: imports a TSV (or CSV) file in a single transaction.
+    #   A line without the five fields raises ValueError and
+    #   nothing from the file is added.
+    def load(self, fp, dialect='excel-tab'):
+        import csv
+        reader = csv.reader(fp, dialect=dialect)
+        def rows():
+            for row in reader:
+                if not row: continue
+                if len(row) != 5:
+                    raise ValueError('line %d: %d fields, expected 5' %
+                                     (reader.line_num, len(row)))
+                yield row
+            return
+        self.addmany(rows())
+        return
+
+    # preload: reads the whole map into memory.
+    def preload(self):
+        rows = self._cur.execute(
+            'SELECT FileName,RepoName,CommitId,SrcPath FROM SourceMap '
+            'ORDER BY Uid;')
+        a = {}
+        for (key,reponame,commit,srcpath) in rows:
+            if key not in a:
+                a[key] = (reponame,commit,srcpath)
+        self._preload = a
+        return
+
     def get(self, key):
+        if self._preload is not None:
+            return self._preload[key]
         rows = self._cur.execute(
-            'SELECT RepoName,CommitId,SrcPath FROM SourceMap WHERE FileName=?;',
+            'SELECT RepoName,CommitId,SrcPath FROM SourceMap WHERE FileName=? '
+            'ORDER BY Uid LIMIT 1;',
             (key,))
-        if not rows: raise KeyError(key)
-        return rows.fetchone()
+        row = rows.fetchone()
+        if row is None: raise KeyError(key)
+        return row
+
+    # get_many: returns {key: (reponame, commit, srcpath)}.
+    #   Missing keys are left out.
+    def get_many(self, keys):
+        keys = list(set(keys))
+        if self._preload is not None:
+            a = self._preload
+            return { key: a[key] for key in keys if key in a }
+        a = {}
+        for i in range(0, len(keys), self.BATCH):
+            batch = keys[i:i+self.BATCH]
+            rows = self._cur.execute(
+                'SELECT FileName,RepoName,CommitId,SrcPath FROM SourceMap '
+                'WHERE FileName IN (%s) ORDER BY Uid;' %
+                ','.join('?'*len(batch)), batch)
+            for (key,reponame,commit,srcpath) in rows:
+                if key not in a:
+                    a[key] = (reponame,commit,srcpath)
+        return a
 
     def geturl(self, key):
-        (reponame,commit,srcpath) = self.get(key)
+        return self._url(self.get(key))
+
+    # geturls: returns {key: url}.
+    def geturls(self, keys):
+        return { key: self._url(row) for (key,row) in self.get_many(keys).items() }
+
+    def _url(self, row):
+        (reponame,commit,srcpath) = row
         url = 'https://github.com/%s/tree/%s/%s' % (reponame, commit, srcpath)
         return url
 
 
+##  ExtractCache
+##
+##  Extractor output keyed by a hash of the file contents
+##  and the extractor settings.  Files that failed to parse are
+##  cached as None.
+##
+class ExtractCache:
+
+    def __init__(self, path):
+        self._conn = sqlite3.connect(path)
+        self._conn.text_factory = str
+        self._cur = self._conn.cursor()
+        self._cur.executescript('''
+CREATE TABLE IF NOT EXISTS ExtractCache (
+    Key TEXT PRIMARY KEY,
+    Data TEXT
+);
+''')
+        self.hits = 0
+        self.misses = 0
+        return
+
+    def close(self):
+        self._conn.commit()
+        return
+
+    def get(self, key):
+        rows = self._cur.execute(
+            'SELECT Data FROM ExtractCache WHERE Key=?;',
+            (key,))
+        row = rows.fetchone()
+        if row is None:
+            self.misses += 1
+            raise KeyError(key)
+        self.hits += 1
+        (data,) = row
+        if data is None: return None
+        if not data: return []
+        return data.split('\n')
+
+    def put(self, key, lines):
+        data = None
+        if lines is not None:
+            data = '\n'.join(lines)
+        self._cur.execute(
+            'INSERT OR REPLACE INTO ExtractCache VALUES (?,?);',
+            (key, data))
+        return
+
+
 ##  SourceFile
 ##
+##  Lines are found on demand and only their offsets are kept.
+##
 class SourceFile:
 
+    # Line boundaries, as in str.splitlines().
+    EOL = re.compile(r'\r\n|[\n\r\x0b\x0c\x1c\x1d\x1e\x85\u2028\u2029]')
+
     def __init__(self, name, data):
         self.name = name
         self.data = data
-        self.lines = data.splitlines(True)
+        self._offsets = None
         return
 
     def __repr__(self):
         return ('<SourceFile(%s)>' %
                 (self.name,))
 
+    # getsize: returns the approximate memory use in bytes.
+    def getsize(self):
+        size = len(self.data)
+        if self._offsets is not None:
+            size += self._offsets.itemsize * len(self._offsets)
+        return size
+
+    # getoffsets: returns the start of each line (and the end of text).
+    def getoffsets(self):
+        if self._offsets is None:
+            offsets = array('l', [0])
+            for m in self.EOL.finditer(self.data):
+                offsets.append(m.end())
+            if offsets[-1] < len(self.data):
+                offsets.append(len(self.data))
+            self._offsets = offsets
+        return self._offsets
+
+    def getnlines(self):
+        return len(self.getoffsets())-1
+
+    def getline(self, lineno):
+        offsets = self.getoffsets()
+        return self.get(offsets[lineno], offsets[lineno+1])
+
     def get(self, start, end):
         return self.data[start:end]
 
@@ -109,12 +276,22 @@ class SourceFile:
             triggers.append((s,-1,anno))
             triggers.append((e,+1,anno))
         triggers.sort(key=lambda x: (x[0],x[1]))
+        offsets = self.getoffsets()
+        n = len(offsets)-1
         lines = {}
-        loc0 = 0
         i = 0
-        annos = []
-        for (lineno,line) in enumerate(self.lines):
-            loc1 = loc0+len(line)
+        # annos: tuple of the open ranges, shared between segments.
+        annos = ()
+        lineno = 0
+        while lineno < n and i < len(triggers):
+            loc0 = offsets[lineno]
+            loc1 = offsets[lineno+1]
+            if not annos and loc1 < triggers[i][0]:
+                # Skip to the line of the next trigger.
+                # (A trigger at the end of a line belongs to that line.)
+                lineno = bisect_left(offsets, triggers[i][0], lineno+1)-1
+                continue
+            line = self.getline(lineno)
             pos0 = 0
             out = []
             while i < len(triggers):
@@ -122,64 +299,207 @@ class SourceFile:
                 if loc1 < loc: break
                 i += 1
                 pos1 = loc - loc0
-                out.append((0, annos[:], line[pos0:pos1]))
+                out.append((0, annos, line[pos0:pos1]))
                 pos0 = pos1
                 if v < 0:
                     out.append((v, anno, None))
-                    annos.append(anno)
+                    annos += (anno,)
                 else:
                     out.append((v, anno, None))
-                    annos.remove(anno)
+                    j = annos.index(anno)
+                    annos = annos[:j] + annos[j+1:]
             if out:
-                out.append((0, annos[:], line[pos0:]))
+                out.append((0, annos, line[pos0:]))
                 lines[lineno] = out
             elif annos:
-                lines[lineno] = [(0, annos[:], line)]
-            loc0 = loc1
-        n = len(self.lines)
+                lines[lineno] = [(0, annos, line)]
+            lineno += 1
         for (lineno,line) in list(lines.items()):
             for i in range(max(0, lineno-ncontext),
                            min(n, lineno+ncontext+1)):
                 if i not in lines:
-                    lines[i] = [(0, [], self.lines[i])]
+                    lines[i] = [(0, (), self.getline(i))]
         lineno0 = 0
         for lineno1 in sorted(lines):
             if lineno0 < lineno1:
                 yield (None, None)
             yield (lineno1, lines[lineno1])
             lineno0 = lineno1+1
-        if lineno0 < len(self.lines):
+        if lineno0 < n:
             yield (None, None)
         return
 
 
+##  MappedSourceFile
+##
+##  A SourceFile that reads the text from a memory-mapped file.
+##  Offsets are still counted in characters and lines end where
+##  SourceFile ends them: lines are decoded when they are indexed
+##  and read, and '\r\n' and '\r' are read as '\n' like a file
+##  opened in text mode.  The file must be in UTF-8.
+##  Like reading the text, it raises UnicodeError on bad bytes.
+##
+class MappedSourceFile(SourceFile):
+
+    # SourceFile.EOL in UTF-8, with '\r' as a line break of its own.
+    BEOL = re.compile(rb'\r\n|[\n\r\x0b\x0c\x1c\x1d\x1e]|\xc2\x85|\xe2\x80[\xa8\xa9]')
+
+    def __init__(self, name, path, encoding='utf-8'):
+        import mmap
+        self.name = name
+        self.encoding = encoding
+        with open(path, 'rb') as fp:
+            if os.fstat(fp.fileno()).st_size:
+                self._mm = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+            else:
+                self._mm = b''
+        self._offsets = None
+        self._boffsets = None
+        # Lines are indexed (and decoded) here so that a bad file
+        # fails when it is opened.
+        self.getoffsets()
+        return
+
+    def __repr__(self):
+        return ('<MappedSourceFile(%s)>' %
+                (self.name,))
+
+    def _decode(self, b):
+        return str(b, self.encoding).replace('\r\n', '\n').replace('\r', '\n')
+
+    # getsize: counts the mapped bytes as well as the offsets.
+    def getsize(self):
+        size = len(self._mm)
+        if self._offsets is not None:
+            size += self._offsets.itemsize * len(self._offsets)
+            size += self._boffsets.itemsize * len(self._boffsets)
+        return size
+
+    # getoffsets: returns the start of each line in characters.
+    #   The byte offsets are kept in _boffsets.
+    def getoffsets(self):
+        if self._offsets is None:
+            mm = self._mm
+            offsets = array('l', [0])
+            boffsets = array('l', [0])
+            (n, i0) = (0, 0)
+            ends = [ m.end() for m in self.BEOL.finditer(mm) ]
+            if not ends or ends[-1] < len(mm):
+                ends.append(len(mm))
+            for i1 in ends:
+                if i1 == 0: continue
+                n += len(self._decode(mm[i0:i1]))
+                offsets.append(n)
+                boffsets.append(i1)
+                i0 = i1
+            (self._offsets, self._boffsets) = (offsets, boffsets)
+        return self._offsets
+
+    def getline(self, lineno):
+        self.getoffsets()
+        boffsets = self._boffsets
+        return self._decode(self._mm[boffsets[lineno]:boffsets[lineno+1]])
+
+    def get(self, start, end):
+        offsets = self.getoffsets()
+        n = len(offsets)-1
+        i0 = min(max(0, bisect_right(offsets, start)-1), n)
+        i1 = min(max(i0, bisect_left(offsets, end)), n)
+        boffsets = self._boffsets
+        text = self._decode(self._mm[boffsets[i0]:boffsets[i1]])
+        return text[start-offsets[i0]:end-offsets[i0]]
+
+
 ##  SourceDB
 ##
+##  Files are kept in LRU order while their total size
+##  stays within maxbytes.  Each mapped file holds a file
+##  descriptor, so at most maxmaps of them are kept.
+##
 class SourceDB:
 
-    def __init__(self, basedir):
+    MAXBYTES = 64*1024*1024
+    MAXMAPS = 64
+
+    def __init__(self, basedir, maxbytes=MAXBYTES, mapped=False,
+                 maxmaps=MAXMAPS):
         self.basedir = basedir
-        self._cache = {}
+        self.maxbytes = maxbytes
+        self.mapped = mapped
+        self.maxmaps = maxmaps
+        self._cache = OrderedDict()
+        # _sizes: {name: size} as of the last access.
+        self._sizes = {}
+        self._size = 0
         return
 
     def get(self, name):
+        # Line offsets are built lazily, so the size of a file is
+        # updated after it was used.
+        if self._cache:
+            self._update(next(reversed(self._cache)))
         if name in self._cache:
             src = self._cache[name]
+            self._cache.move_to_end(name)
         else:
             path = os.path.join(self.basedir, name)
             try:
-                with open(path) as fp:
-                    data = fp.read()
+                if self.mapped:
+                    src = MappedSourceFile(name, path)
+                else:
+                    with open(path) as fp:
+                        data = fp.read()
+                    src = SourceFile(name, data)
             except IOError:
                 raise KeyError(name)
             except UnicodeError:
                 raise KeyError(name)
-            src = SourceFile(name, data)
             self._cache[name] = src
+            self._sizes[name] = 0
+        self._update(name)
+        while ((self.maxbytes < self._size or
+                (self.mapped and self.maxmaps < len(self._cache))) and
+               1 < len(self._cache)):
+            (k,_) = self._cache.popitem(last=False)
+            self._size -= self._sizes.pop(k)
         return src
 
+    def _update(self, name):
+        size = self._cache[name].getsize()
+        self._size += size - self._sizes[name]
+        self._sizes[name] = size
+        return
+
     def show(self, fp=sys.stdout):
         for src in self._cache.values():
             for (_,line) in src.show():
                 fp.write(line)
         return
+
+
+def main(argv):
+    import getopt
+    def usage():
+        print('usage: %s srcmap.db [map.tsv|map.csv ...]' % argv[0])
+        return 100
+    try:
+        (opts, args) = getopt.getopt(argv[1:], '')
+    except getopt.GetoptError:
+        return usage()
+    if not args: return usage()
+    srcmap = SourceMap(args.pop(0))
+    for path in (args or ['-']):
+        dialect = 'excel' if path.endswith('.csv') else 'excel-tab'
+        try:
+            if path == '-':
+                srcmap.load(sys.stdin, dialect=dialect)
+            else:
+                with open(path, newline='') as fp:
+                    srcmap.load(fp, dialect=dialect)
+        except ValueError as e:
+            print('%s: %s' % (path, e), file=sys.stderr)
+            return usage()
+    srcmap.close()
+    return 0
+
+if __name__ == '__main__': sys.exit(main(sys.argv))
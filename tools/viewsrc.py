@@ -7,24 +7,26 @@ def main(argv):
     import fileinput
     import getopt
     def usage():
-        print('usage: %s [-c context] [-f k=v] basedir out.comm' %
+        print('usage: %s [-c context] [-f k=v] [-M] basedir out.comm' %
               argv[0])
         return 100
     try:
-        (opts, args) = getopt.getopt(argv[1:], 'c:f:')
+        (opts, args) = getopt.getopt(argv[1:], 'c:f:M')
     except getopt.GetoptError:
         return usage()
     ncontext = 4
     filters = []
+    mapped = False
     for (k, v) in opts:
         if k == '-c': ncontext = int(v)
         elif k == '-f':
             (a,_,b) = v.partition('=')
             filters.append((a,b))
+        elif k == '-M': mapped = True
     if not args: return usage()
 
     path = args.pop(0)
-    srcdb = SourceDB(path)
+    srcdb = SourceDB(path, mapped=mapped)
 
     fp = fileinput.input(args)
     for e in CommentEntry.load(fp):